@@ -1,48 +1,1501 @@
 import os
+import re
 import uuid
+import hashlib
+import base64
+import json
+import urllib.request
 import sqlite3
 import random
+import math
 import string
 import csv
 import io
-from datetime import datetime, timedelta
+import mmap
+import time
+import threading
+import functools
+import itertools
+import queue
+import concurrent.futures
+import abc
+import gzip
+import heapq
+import zlib
+import shutil
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
-from flask import Flask, request, render_template, redirect, url_for
+from flask import (
+    Flask, request, render_template, redirect, url_for, jsonify,
+    send_from_directory, abort, make_response, Response, stream_template
+)
+from werkzeug.http import is_resource_modified
+import click
 import qrcode
 
-app = Flask(__name__)
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+app = Flask(__name__, static_folder='Static')
 
 DATABASE = 'coupons.db'
 DEFAULT_DOMAIN = 'elpatrontaqueriabar.ca'
+# Days a new coupon stays valid, unless its client has its own default
+DEFAULT_EXPIRY_DAYS = 30
 
 # This is your local folder for QR images
 STATIC_QR_FOLDER = '/home/Luxtech/Coupon-gen/qr-images'
 # This is the exact link you see in the PythonAnywhere file manager
 # (not publicly accessible, but stored in CSV).
 FILE_MANAGER_URL = "https://luxtech.pythonanywhere.com/qr_images/"
+# CSVs of generated batches are written here while the page streams, and
+# downloaded from /generated/<name> afterwards. They hold customer emails, so
+# the sweeper deletes them GENERATED_CSV_MAX_AGE seconds after their last write.
+GENERATED_CSV_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generated_csv')
+GENERATED_CSV_MAX_AGE = 24 * 3600
+# Coupons redeemed/expired for longer than ARCHIVE_AFTER_DAYS are moved out of
+# the coupons table into gzip NDJSON files (one per month) in ARCHIVE_FOLDER,
+# leaving a tombstone (code + final status) in archived_codes.
+ARCHIVE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_CHUNK_SIZE = 1000
+# Online snapshots (`flask backup`, POST /admin/backup) are copied through the
+# SQLite backup API BACKUP_PAGES_PER_STEP pages at a time, pausing
+# BACKUP_STEP_PAUSE seconds between steps so live requests get the database in
+# between. Every write by another connection restarts a paged copy; after
+# BACKUP_MAX_RESTARTS of those it finishes in one step, which under WAL only
+# holds a read snapshot. The newest BACKUP_KEEP snapshots are kept.
+BACKUP_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005
+BACKUP_MAX_RESTARTS = 3
+BACKUP_KEEP = 7
+# Materialized coupons.status: the sweeper flips active rows past expires_at
+# to expired every SWEEP_INTERVAL seconds, SWEEP_CHUNK_SIZE rows per transaction
+SWEEP_INTERVAL = 60
+SWEEP_CHUNK_SIZE = 1000
+# SQLite connections are kept open, one per thread, and set up with these
+# pragmas once. WAL lets validation read while a batch is being generated.
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),   # durable across app crashes; WAL makes it safe
+    ('busy_timeout', 5000),      # ms to wait for the write lock before "database is locked"
+    ('cache_size', -32000),      # negative = KiB, i.e. 32 MB of page cache
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+]
+# Prepared statements kept per connection (sqlite3's default is 128)
+SQLITE_STATEMENT_CACHE = 256
+# False: get_db() opens a plain sqlite3 connection every time (the old behaviour)
+POOL_CONNECTIONS = True
+# App writes go through one writer thread per process (see WriteQueue), which
+# commits everything that queued up while its last commit ran as one group.
+# GROUP_COMMIT_WINDOW is extra time (s) to wait for more ops before committing;
+# worth raising only where each commit's fsync is slow.
+GROUP_COMMIT_WINDOW = 0
+GROUP_COMMIT_MAX_OPS = 256
+# Optional sharded storage. With SHARD_COUNT > 0 coupons live in SHARD_COUNT
+# SQLite files in SHARD_FOLDER instead of DATABASE, each with its own writer,
+# so one client's big batch doesn't hold up everyone else's redemptions.
+# A client's coupons all go to one shard (a stable hash of its name), and each
+# shard owns the codes whose first character after the prefix maps to it, so
+# a code's shard is known without a lookup. SHARD_CATALOG records the layout;
+# it can't change once shards hold data. Shard n's ids start at
+# n << SHARD_ID_BITS, so ids stay unique across shards.
+SHARD_COUNT = 0
+SHARD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shards')
+SHARD_CATALOG = 'catalog.json'
+SHARD_ID_BITS = 40
+GENERATED_CSV_FIELDS = ['email', 'code', 'qr_file', 'qr_link', 'created_at', 'expires_at', 'redeemed', 'client']
 
-def init_db():
-    """Create the coupons table if it doesn't already exist."""
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
+# Offline scanner sync: largest batch accepted in one request, and how many
+# codes we put in a single "WHERE code IN (...)" (SQLite caps bound variables).
+MAX_SYNC_BATCH = 10000
+SQL_IN_CHUNK = 500
+# Numeric scanned_at values above this are milliseconds (JavaScript's
+# Date.now()); in seconds it would be the year 5138. Scan times outside
+# 2000-01-01 .. 3000-01-01 are rejected as unreadable.
+SCAN_TIME_MS_THRESHOLD = 10 ** 11
+SCAN_TIME_RANGE = (946684800, 32503680000)
+
+# In-process cache of terminal coupon states, checked before the database.
+# Other workers can't invalidate it, so entries are checked against the shared
+# status map when it's built; "expired" isn't cached at all (a bulk extend
+# revives it) and "not_found" gets a short TTL for when the map isn't built.
+STATE_CACHE_MAX_ENTRIES = 50000
+STATE_CACHE_TTL = {'redeemed': 600, 'not_found': 30}
+
+# Timestamps are stored as integer UTC epoch seconds. Rows written before that
+# hold local-time strings like "2025-03-12 03:09:24.972414"; this expression
+# reads either form as epoch seconds so SQL comparisons work mid-migration.
+EXPIRES_AT_EPOCH_SQL = (
+    "CASE WHEN typeof(expires_at) = 'text' "
+    "THEN CAST(strftime('%s', expires_at, 'utc') AS INTEGER) "
+    "ELSE expires_at END"
+)
+TIMESTAMP_COLUMNS = ('created_at', 'expires_at', 'redeemed_at')
+DISPLAY_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Codes are "VIP" + 4 chars from CODE_ALPHABET (see generate_coupon_code).
+# The database stores a code as code_num, its position in that code space
+# (see code_index); the prefix lives in the schema (the generated code column).
+CODE_PREFIX = "VIP"
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 4
+
+# Shared 2-bit-per-code status map over the whole code space (~420 KB),
+# mmap'd by every worker so "not found" / "already redeemed" / "expired"
+# can be answered without SQLite.
+STATUS_MAP_FILE = 'code_status.map'
+STATUS_ABSENT, STATUS_ACTIVE, STATUS_REDEEMED, STATUS_EXPIRED = range(4)
+STATUS_MAP_STATES = {
+    STATUS_ABSENT: 'not_found',
+    STATUS_REDEEMED: 'redeemed',
+    STATUS_EXPIRED: 'expired',
+}
+
+# Third-party scripts we serve ourselves from Static/, pinned to these
+# versions. The files belong in the repo (`flask vendor-assets` downloads or
+# refreshes them); while one is missing, asset_url() falls back to the same
+# pinned version on the CDN so the page keeps working.
+VENDOR_ASSETS = {
+    'vendor/html5-qrcode.min.js': 'https://unpkg.com/html5-qrcode@2.3.8/html5-qrcode.min.js',
+}
+# Content-hashed asset URLs never change content, so browsers may keep them for a year
+ASSET_MAX_AGE = 365 * 24 * 3600
+HASHED_ASSET_RE = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{12})(?P<ext>\.[A-Za-z0-9]+)$')
+
+# /history keyset pagination. Only these columns can be sorted on; each has
+# an index and ties are broken by id, so (column, id) is a unique cursor.
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 500
+HISTORY_SORT_COLUMNS = ('id', 'created_at', 'expires_at', 'code')
+# Fields of the coupon dicts CouponStore.list produces
+LIST_FIELDS = ('id', 'code', 'email', 'redeemed', 'status', 'domain', 'client', 'created_at', 'expires_at', 'code_num')
+# Fields of the client dicts CouponStore.client / clients produce
+CLIENT_FIELDS = ('id', 'name', 'domain', 'expiry_days')
+# Rounds of redrawing clashing codes before allocate gives up (the code space is full)
+ALLOCATE_MAX_ROUNDS = 20
+# Filters shared by /history and /history/export
+HISTORY_STATUSES = ('active', 'redeemed', 'expired')
+HISTORY_DATE_FIELDS = ('created_at', 'redeemed_at')
+EXPORT_FIELDS = ['id', 'code', 'email', 'client', 'domain', 'status',
+                 'created_at', 'expires_at', 'redeemed', 'redeemed_at']
+# Rows written per chunk of a streamed export
+EXPORT_CHUNK_ROWS = 500
+
+# Redemption analytics. Time-to-redeem is counted in these buckets
+# (upper bound in seconds, label); anything slower goes in the last one.
+REDEEM_LATENCY_BUCKETS = [
+    (3600, '< 1 hour'),
+    (6 * 3600, '1-6 hours'),
+    (24 * 3600, '6-24 hours'),
+    (3 * 24 * 3600, '1-3 days'),
+    (7 * 24 * 3600, '3-7 days'),
+    (14 * 24 * 3600, '1-2 weeks'),
+    (30 * 24 * 3600, '2-4 weeks'),
+]
+REDEEM_LATENCY_OVERFLOW = '30+ days'
+DASHBOARD_HOURLY_WINDOW = 7 * 24  # hours shown in the per-hour chart
+DASHBOARD_MAX_BATCHES = 30
+
+# Conditional GET / rendered page cache for listing pages. Pages that depend
+# on the clock (e.g. expired counts) also change every PAGE_TIME_BUCKET seconds.
+PAGE_CACHE_MAX_ENTRIES = 256
+# Streamed pages bigger than this are sent but not kept in the page cache
+PAGE_CACHE_MAX_BYTES = 512 * 1024
+PAGE_TIME_BUCKET = 60
+
+# Bulk actions on /history: rows per transaction, and where to send the user back to
+BULK_CHUNK_SIZE = 500
+BULK_ACTIONS = ('delete', 'extend', 'redeem')
+SAFE_REDIRECT_PREFIXES = ('/history', '/search')
+
+# Search results per page, and the shortest query the trigram index can match
+SEARCH_PAGE_SIZE = 50
+SEARCH_MIN_LENGTH = 3
+
+# Settings create_app(config) can override (also read from COUPONS_<NAME>
+# environment variables). Everything else stays at the values above.
+SETTINGS = (
+    'DATABASE', 'DEFAULT_DOMAIN', 'DEFAULT_EXPIRY_DAYS', 'STATIC_QR_FOLDER', 'FILE_MANAGER_URL',
+    'GENERATED_CSV_FOLDER', 'GENERATED_CSV_MAX_AGE', 'ARCHIVE_FOLDER', 'BACKUP_FOLDER', 'STATUS_MAP_FILE',
+    'SHARD_COUNT', 'SHARD_FOLDER', 'POOL_CONNECTIONS', 'SWEEP_INTERVAL', 'GROUP_COMMIT_WINDOW',
+)
+
+STATE_MESSAGES = {
+    'valid': "This coupon is valid and now redeemed!",
+    'redeemed': "This coupon has already been redeemed.",
+    'expired': "This coupon has expired.",
+    'not_found': "Coupon code not found.",
+}
+
+class StateCache:
+    """
+    Bounded LRU cache of terminal coupon states (redeemed, not_found),
+    with a per-state TTL. Active coupons are never cached: they can change on
+    the next scan. Safe to share between threads of one worker.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, code):
+        """Returns the cached state for a code, or None."""
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None:
+                self.misses += 1
+                return None
+            state, expires = entry
+            if expires < time.monotonic():
+                del self._entries[code]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(code)
+            self.hits += 1
+            return state
+
+    def put(self, code, state):
+        """Caches a terminal state; anything else just drops the entry."""
+        if state not in self.ttl:
+            self.invalidate(code)
+            return
+        with self._lock:
+            self._entries[code] = (state, time.monotonic() + self.ttl[state])
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *codes):
+        with self._lock:
+            for code in codes:
+                self._entries.pop(code, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+state_cache = StateCache(STATE_CACHE_MAX_ENTRIES, STATE_CACHE_TTL)
+
+def code_index(code):
+    """
+    Position of a code in the code space (VIPAAAA = 0), or None if
+    the code doesn't follow the VIP + 4 chars format.
+    """
+    if len(code) != len(CODE_PREFIX) + CODE_LENGTH or not code.startswith(CODE_PREFIX):
+        return None
+    index = 0
+    for char in code[len(CODE_PREFIX):]:
+        digit = CODE_ALPHABET.find(char)
+        if digit < 0:
+            return None
+        index = index * len(CODE_ALPHABET) + digit
+    return index
+
+def code_columns(code):
+    """(code_num, code_text) to store a code as; code_text only for codes outside the code space."""
+    index = code_index(code)
+    return (index, None) if index is not None else (None, code)
+
+def code_condition(codes):
+    """
+    WHERE condition, and its params, matching coupons with any of these
+    codes through the code_num index (code_text for odd legacy codes).
+    """
+    nums = []
+    texts = []
+    for code in codes:
+        index = code_index(code)
+        if index is None:
+            texts.append(code)
+        else:
+            nums.append(index)
+    parts = []
+    if nums:
+        parts.append(f"code_num IN ({','.join('?' * len(nums))})")
+    if texts:
+        parts.append(f"code_text IN ({','.join('?' * len(texts))})")
+    if not parts:
+        return "0", []
+    return "(" + " OR ".join(parts) + ")", nums + texts
+
+class CodeStatusMap:
+    """
+    2-bit status per possible code, kept in a memory-mapped file shared by
+    all worker processes. Writes go through on insert, redeem and delete;
+    `flask rebuild-status-map` rebuilds it from the database.
+    The map is only trusted once a rebuild has written its header.
+    """
+
+    MAGIC = b'CSMAP\x00\x00\x01'
+    HEADER_SIZE = len(MAGIC)
+    CODE_SPACE = len(CODE_ALPHABET) ** CODE_LENGTH
+
+    def __init__(self, path):
+        self.path = path
+        self.size = self.HEADER_SIZE + (self.CODE_SPACE + 3) // 4
+        self._file = None
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Maps the file on first use. Returns None if it's missing or not built."""
+        if self._mm is None:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) != self.size:
+                return None
+            self._file = open(self.path, 'r+b')
+            self._mm = mmap.mmap(self._file.fileno(), self.size)
+        if self._mm[:self.HEADER_SIZE] != self.MAGIC:
+            return None
+        return self._mm
+
+    def _write_locked(self, fn):
+        """Runs fn() while holding the thread lock and, where available, a file lock."""
+        with self._lock:
+            if fcntl:
+                fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                fn()
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def is_ready(self):
+        return self._open() is not None
+
+    def get(self, code):
+        """Returns the STATUS_* for a code, or None when the DB must be asked."""
+        index = code_index(code)
+        mm = self._open() if index is not None else None
+        if mm is None:
+            return None
+        byte = mm[self.HEADER_SIZE + index // 4]
+        return (byte >> ((index % 4) * 2)) & 0b11
+
+    def set_many(self, statuses):
+        """Writes (code, STATUS_*) pairs through to the map."""
+        mm = self._open()
+        if mm is None:
+            return
+        positions = [(code_index(code), status) for code, status in statuses]
+        positions = [(index, status) for index, status in positions if index is not None]
+
+        def write():
+            for index, status in positions:
+                offset = self.HEADER_SIZE + index // 4
+                shift = (index % 4) * 2
+                mm[offset] = (mm[offset] & ~(0b11 << shift) & 0xFF) | (status << shift)
+        self._write_locked(write)
+
+    def set(self, code, status):
+        self.set_many([(code, status)])
+
+    def rebuild(self, conns):
+        """
+        Recomputes every code's status from the coupons tables and archive
+        tombstones of these connections (one per shard).
+        """
+        buf = bytearray(self.size - self.HEADER_SIZE)
+        count = 0
+        for conn in conns:
+            c = conn.cursor()
+            c.execute(
+                f"""
+                SELECT code, redeemed, ({EXPIRES_AT_EPOCH_SQL}) < ? FROM coupons
+                UNION ALL
+                SELECT code, status = {STATUS_REDEEMED}, status = {STATUS_EXPIRED} FROM archived_codes
+                """,
+                (now_epoch(),)
+            )
+            for code, redeemed, expired in c:
+                index = code_index(code or '')
+                if index is None:
+                    continue
+                status = STATUS_REDEEMED if redeemed else STATUS_EXPIRED if expired else STATUS_ACTIVE
+                buf[index // 4] |= status << ((index % 4) * 2)
+                count += 1
+
+        if not os.path.exists(self.path) or os.path.getsize(self.path) != self.size:
+            with open(self.path, 'wb') as f:
+                f.write(bytes(self.size))
+            self.close()
+        self._open()
+
+        def write():
+            # Header last, so readers never trust a half-written map
+            self._mm[:self.HEADER_SIZE] = bytes(self.HEADER_SIZE)
+            self._mm[self.HEADER_SIZE:] = bytes(buf)
+            self._mm[:self.HEADER_SIZE] = self.MAGIC
+            self._mm.flush()
+        self._write_locked(write)
+        return count
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+        self._mm = None
+        self._file = None
+
+status_map = CodeStatusMap(STATUS_MAP_FILE)
+
+def now_epoch():
+    """Current time as integer UTC epoch seconds."""
+    return int(time.time())
+
+def to_epoch(value):
+    """
+    Converts a stored timestamp to epoch seconds.
+    Accepts integers (current format) and the old local-time strings,
+    with or without microseconds. Returns None for empty/unreadable values.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(str(value).strip()).timestamp())
+    except ValueError:
+        return None
+
+def format_epoch(value):
+    """Formats a stored timestamp (either format) as local time for display."""
+    epoch = to_epoch(value)
+    if epoch is None:
+        return ''
+    return datetime.fromtimestamp(epoch).strftime(DISPLAY_TIME_FORMAT)
+
+_local = threading.local()
+
+def close_db():
+    """Closes this thread's pooled connections (they reopen on next use)."""
+    for conn in getattr(_local, 'conns', {}).values():
+        conn.close()
+    _local.conns = {}
+
+def connect_db(path=None):
+    """Opens a new SQLite connection with SQLITE_PRAGMAS applied."""
+    conn = sqlite3.connect(path or DATABASE, timeout=5, cached_statements=SQLITE_STATEMENT_CACHE)
+    for name, value in SQLITE_PRAGMAS:
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+def get_db(path=None):
+    """
+    Returns this thread's SQLite connection to path (DATABASE by default),
+    opening it on first use.
+    Use it as `with get_db() as conn:` like a fresh connection: the block
+    commits or rolls back, but the connection stays open for the thread's
+    next request, with its statement cache warm. Don't close it.
+    """
+    path = path or DATABASE
+    if not POOL_CONNECTIONS:
+        return sqlite3.connect(path)
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = connect_db(path)
+    return conn
+
+class WriteQueue:
+    """
+    The process's single SQLite writer. submit(fn) queues fn(cursor) and
+    returns a Future; the writer thread runs whatever has queued up in one
+    transaction, each op inside its own savepoint
+    so a failing op only rolls back itself, and resolves the futures once
+    the commit has landed. Requests never wait on each other for SQLite's
+    write lock, and one fsync covers the whole group.
+    Ops run on the writer thread: they must not commit, and must not wait
+    on the queue themselves.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fn):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+        self._queue.put((fn, future))
+        return future
+
+    def run(self, fn):
+        """Runs fn(cursor) on the writer and returns its result once committed (or raises its error)."""
+        return self.submit(fn).result()
+
+    def _run(self):
+        while True:
+            ops = [self._queue.get()]
+            deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+            while len(ops) < GROUP_COMMIT_MAX_OPS:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        ops.append(self._queue.get(timeout=timeout))
+                    else:
+                        ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(ops)
+
+    def _commit(self, ops):
+        outcomes = []
+        conn = None
+        try:
+            # Inside the try: if the connection can't be opened, these ops'
+            # callers get the error instead of the writer thread dying
+            conn = get_db(self.path)
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            for fn, future in ops:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                c.execute("SAVEPOINT op")
+                try:
+                    outcomes.append((future, fn(c), None))
+                except Exception as e:
+                    c.execute("ROLLBACK TO op")
+                    outcomes.append((future, None, e))
+                c.execute("RELEASE op")
+            conn.commit()
+        except Exception as e:
+            # Connecting, BEGIN or COMMIT failed: nothing in this group landed
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+            for _, future in ops:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+write_queue = WriteQueue()
+
+class ShardCatalog:
+    """
+    Routes coupons to shard files (see SHARD_COUNT): clients by a stable
+    hash of their name, codes by the character after CODE_PREFIX. Codes
+    outside the code space live in shard 0. The layout is written to
+    SHARD_CATALOG on first use and checked against the config after that.
+    """
+
+    def __init__(self, folder, count):
+        self.folder = folder
+        self.count = count
+        self.paths = [os.path.join(folder, f"shard-{n:02d}.db") for n in range(count)]
+        self._writers = [WriteQueue(path) for path in self.paths]
+
+    def prefixes(self, shard):
+        """The first code characters (after CODE_PREFIX) owned by a shard."""
+        return ''.join(char for digit, char in enumerate(CODE_ALPHABET) if digit % self.count == shard)
+
+    def for_client(self, client_name):
+        # crc32, not hash(): it must agree across worker processes and restarts.
+        # Case-folded like the clients table, so "ACME" and "acme" share a shard.
+        return zlib.crc32(client_key(client_name)) % self.count
+
+    def for_code(self, code):
+        index = code_index(code)
+        if index is None:
+            return 0
+        return index // len(CODE_ALPHABET) ** (CODE_LENGTH - 1) % self.count
+
+    def writer(self, shard):
+        return self._writers[shard]
+
+    def check(self):
+        """Writes the catalog if it's missing, or raises if it disagrees with this config."""
+        os.makedirs(self.folder, exist_ok=True)
+        layout = {
+            'shard_count': self.count,
+            'client_hash': 'crc32-nocase',
+            'code_prefix': CODE_PREFIX,
+            'prefixes': [self.prefixes(n) for n in range(self.count)],
+        }
+        path = os.path.join(self.folder, SHARD_CATALOG)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved != layout:
+                raise RuntimeError(
+                    f"{path} has {saved.get('shard_count')} shards but SHARD_COUNT is {self.count}; "
+                    "existing shards can't be re-split"
+                )
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump(layout, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+shards = ShardCatalog(SHARD_FOLDER, SHARD_COUNT) if SHARD_COUNT else None
+_shard_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(SHARD_COUNT, 1), thread_name_prefix='shard')
+
+def all_dbs():
+    """Every database file holding coupons: the shards, or just DATABASE."""
+    return shards.paths if shards else [DATABASE]
+
+def client_db(client_name):
+    """Database file holding a client's coupons."""
+    return shards.paths[shards.for_client(client_name)] if shards else DATABASE
+
+def code_db(code):
+    """Database file holding a code, whoever it belongs to."""
+    return shards.paths[shards.for_code(code)] if shards else DATABASE
+
+def writer_for(path):
+    """The WriteQueue that owns writes to a database file."""
+    if shards and path in shards.paths:
+        return shards.writer(shards.paths.index(path))
+    return write_queue
+
+def fan_out(fn, paths=None):
+    """
+    Runs fn(path) for every database (or the given ones), in parallel when
+    there is more than one, and returns the results in the same order.
+    """
+    paths = all_dbs() if paths is None else list(paths)
+    if len(paths) == 1:
+        return [fn(paths[0])]
+    return list(_shard_pool.map(fn, paths))
+
+# Schema migrations, applied in order at startup. A migration's version is
+# its position in this list (1-based) and the DB records the last one applied
+# in PRAGMA user_version. Never reorder or edit a released migration: append.
+MIGRATIONS = []
+
+def migration(fn):
+    """Registers fn(cursor) as the next schema migration."""
+    MIGRATIONS.append(fn)
+    return fn
+
+@migration
+def create_coupons_table(c):
+    """Create the coupons table."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS coupons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT,
+            code TEXT UNIQUE,
+            created_at INTEGER,
+            expires_at INTEGER,
+            redeemed INTEGER DEFAULT 0,
+            domain TEXT,
+            client TEXT,
+            redeemed_at INTEGER
+        )
+    ''')
+
+@migration
+def migrate_timestamps_to_epoch(c):
+    """
+    Rewrite old string timestamps as integer epoch seconds.
+    The strings were written with datetime.now(), i.e. local time.
+    Rows SQLite can't parse are left alone (to_epoch still reads them).
+    """
+    for column in TIMESTAMP_COLUMNS:
+        c.execute(f"""
+            UPDATE coupons
+            SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+            WHERE typeof({column}) = 'text' AND strftime('%s', {column}) IS NOT NULL
+        """)
+
+@migration
+def add_coupon_counter(c):
+    """Row count kept up to date by triggers, so pages never run COUNT(*)."""
+    c.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    c.execute("INSERT OR IGNORE INTO counters (name, value) SELECT 'coupons', COUNT(*) FROM coupons")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS coupons_count_insert AFTER INSERT ON coupons
+        BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'coupons';
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS coupons_count_delete AFTER DELETE ON coupons
+        BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'coupons';
+        END
+    ''')
+
+@migration
+def add_coupon_indexes(c):
+    """
+    Index every column history and validate_coupon filter or sort on.
+    (code is already covered by its UNIQUE index.)
+    """
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_client_created_at ON coupons (client, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_created_at ON coupons (created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_expires_at ON coupons (expires_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_redeemed ON coupons (redeemed)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_email ON coupons (email)")
+    c.execute("ANALYZE coupons")
+
+@migration
+def add_coupon_search_index(c):
+    """
+    Trigram full-text index over code, email and client, kept in sync by
+    triggers. Trigrams give substring as well as prefix matches.
+    Skipped on SQLite builds without FTS5/trigram (search falls back to LIKE).
+    """
+    try:
         c.execute('''
-            CREATE TABLE IF NOT EXISTS coupons (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT,
-                code TEXT UNIQUE,
-                created_at TIMESTAMP,
-                expires_at TIMESTAMP,
-                redeemed INTEGER DEFAULT 0,
-                domain TEXT,
-                client TEXT,
-                redeemed_at TIMESTAMP
+            CREATE VIRTUAL TABLE IF NOT EXISTS coupons_fts USING fts5(
+                code, email, client,
+                content='coupons', content_rowid='id', tokenize='trigram'
             )
         ''')
-        conn.commit()
+    except sqlite3.OperationalError:
+        return
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS coupons_fts_insert AFTER INSERT ON coupons
+        BEGIN
+            INSERT INTO coupons_fts (rowid, code, email, client)
+            VALUES (new.id, new.code, new.email, new.client);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS coupons_fts_delete AFTER DELETE ON coupons
+        BEGIN
+            INSERT INTO coupons_fts (coupons_fts, rowid, code, email, client)
+            VALUES ('delete', old.id, old.code, old.email, old.client);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS coupons_fts_update AFTER UPDATE OF code, email, client ON coupons
+        BEGIN
+            INSERT INTO coupons_fts (coupons_fts, rowid, code, email, client)
+            VALUES ('delete', old.id, old.code, old.email, old.client);
+            INSERT INTO coupons_fts (rowid, code, email, client)
+            VALUES (new.id, new.code, new.email, new.client);
+        END
+    ''')
+    c.execute("INSERT INTO coupons_fts (coupons_fts) VALUES ('rebuild')")
+
+# Never-expiring coupons go in this client_expiry bucket
+NO_EXPIRY = 2 ** 63 - 1
+
+def _client_stats_add(row):
+    """Trigger statements adding a coupon row (new/old) to the per-client rollups."""
+    return f"""
+        INSERT INTO client_stats (client, issued, redeemed)
+        VALUES (COALESCE({row}.client, ''), 1, {row}.redeemed != 0)
+        ON CONFLICT (client) DO UPDATE SET
+            issued = issued + 1,
+            redeemed = redeemed + excluded.redeemed;
+        INSERT INTO client_expiry (client, expires_at, pending)
+        SELECT COALESCE({row}.client, ''), COALESCE({row}.expires_at, {NO_EXPIRY}), 1
+        WHERE {row}.redeemed = 0
+        ON CONFLICT (client, expires_at) DO UPDATE SET pending = pending + 1;
+    """
+
+def _client_stats_remove(row):
+    """Trigger statements taking a coupon row (new/old) back out of the rollups."""
+    return f"""
+        UPDATE client_stats
+        SET issued = issued - 1, redeemed = redeemed - ({row}.redeemed != 0)
+        WHERE client = COALESCE({row}.client, '');
+        DELETE FROM client_stats WHERE client = COALESCE({row}.client, '') AND issued <= 0;
+        UPDATE client_expiry SET pending = pending - 1
+        WHERE {row}.redeemed = 0
+          AND client = COALESCE({row}.client, '')
+          AND expires_at = COALESCE({row}.expires_at, {NO_EXPIRY});
+        DELETE FROM client_expiry
+        WHERE client = COALESCE({row}.client, '')
+          AND expires_at = COALESCE({row}.expires_at, {NO_EXPIRY})
+          AND pending <= 0;
+    """
+
+@migration
+def add_client_stats(c):
+    """
+    Per-client rollups kept up to date by triggers:
+      client_stats:  issued / redeemed counts per client
+      client_expiry: unredeemed coupons per (client, expires_at). A batch
+                     shares one expires_at, so this is about one row per
+                     batch, and "expired" is a sum over rows already past.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS client_stats (
+            client TEXT PRIMARY KEY,
+            issued INTEGER NOT NULL DEFAULT 0,
+            redeemed INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS client_expiry (
+            client TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            pending INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (client, expires_at)
+        )
+    ''')
+    c.execute("DELETE FROM client_stats")
+    c.execute("DELETE FROM client_expiry")
+    c.execute('''
+        INSERT INTO client_stats (client, issued, redeemed)
+        SELECT COALESCE(client, ''), COUNT(*), SUM(redeemed != 0) FROM coupons GROUP BY 1
+    ''')
+    c.execute(f'''
+        INSERT INTO client_expiry (client, expires_at, pending)
+        SELECT COALESCE(client, ''), COALESCE(expires_at, {NO_EXPIRY}), COUNT(*)
+        FROM coupons WHERE redeemed = 0 GROUP BY 1, 2
+    ''')
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS client_stats_insert AFTER INSERT ON coupons
+        BEGIN {_client_stats_add('new')} END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS client_stats_delete AFTER DELETE ON coupons
+        BEGIN {_client_stats_remove('old')} END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS client_stats_update
+        AFTER UPDATE OF client, redeemed, expires_at ON coupons
+        BEGIN {_client_stats_remove('old')} {_client_stats_add('new')} END
+    """)
+
+def _analytics_rollup(row, sign):
+    """
+    Trigger statements adding (sign '+') or removing (sign '-') a coupon
+    row's contribution to the analytics rollups, and bumping their version.
+    """
+    latency = f"({row}.redeemed_at - {row}.created_at)"
+    bucket = "CASE " + " ".join(
+        f"WHEN {latency} < {limit} THEN {index}"
+        for index, (limit, _) in enumerate(REDEEM_LATENCY_BUCKETS)
+    ) + f" ELSE {len(REDEEM_LATENCY_BUCKETS)} END"
+    return f"""
+        INSERT INTO hourly_stats (hour, client, issued, redeemed)
+        VALUES (COALESCE({row}.created_at, 0) / 3600 * 3600, COALESCE({row}.client, ''), {sign}1, 0)
+        ON CONFLICT (hour, client) DO UPDATE SET issued = issued + excluded.issued;
+        INSERT INTO hourly_stats (hour, client, issued, redeemed)
+        SELECT COALESCE({row}.redeemed_at, {row}.created_at, 0) / 3600 * 3600,
+               COALESCE({row}.client, ''), 0, {sign}1
+        WHERE {row}.redeemed != 0
+        ON CONFLICT (hour, client) DO UPDATE SET redeemed = redeemed + excluded.redeemed;
+        INSERT INTO batch_stats (client, created_at, issued, redeemed)
+        VALUES (COALESCE({row}.client, ''), COALESCE({row}.created_at, 0), {sign}1, {sign}({row}.redeemed != 0))
+        ON CONFLICT (client, created_at) DO UPDATE SET
+            issued = issued + excluded.issued,
+            redeemed = redeemed + excluded.redeemed;
+        INSERT INTO redeem_latency (bucket, count)
+        SELECT {bucket}, {sign}1
+        WHERE {row}.redeemed != 0 AND {row}.redeemed_at IS NOT NULL AND {row}.created_at IS NOT NULL
+        ON CONFLICT (bucket) DO UPDATE SET count = count + excluded.count;
+        UPDATE counters SET value = value + 1 WHERE name = 'analytics_version';
+    """
+
+@migration
+def add_analytics_rollups(c):
+    """
+    Rollups behind the analytics dashboard, kept current by triggers:
+      hourly_stats:   issued (by created hour) / redeemed (by redeemed hour) per client
+      batch_stats:    issued / redeemed per generation batch (client + created_at)
+      redeem_latency: histogram of time-to-redeem (REDEEM_LATENCY_BUCKETS)
+    counters.analytics_version changes whenever any of them do.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS hourly_stats (
+            hour INTEGER NOT NULL,
+            client TEXT NOT NULL,
+            issued INTEGER NOT NULL DEFAULT 0,
+            redeemed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, client)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS batch_stats (
+            client TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            issued INTEGER NOT NULL DEFAULT 0,
+            redeemed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (client, created_at)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS redeem_latency (
+            bucket INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('analytics_version', 0)")
+    # Backfill by replaying every existing row through the same statements
+    # the triggers use, via a temporary trigger on a scratch table.
+    c.execute("CREATE TEMP TABLE analytics_backfill AS SELECT * FROM coupons WHERE 0")
+    c.execute(f"""
+        CREATE TEMP TRIGGER analytics_backfill_insert AFTER INSERT ON analytics_backfill
+        BEGIN {_analytics_rollup('new', '+')} END
+    """)
+    c.execute("INSERT INTO analytics_backfill SELECT * FROM coupons")
+    c.execute("DROP TABLE analytics_backfill")
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS analytics_insert AFTER INSERT ON coupons
+        BEGIN {_analytics_rollup('new', '+')} END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS analytics_delete AFTER DELETE ON coupons
+        BEGIN {_analytics_rollup('old', '-')} END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS analytics_update
+        AFTER UPDATE OF client, created_at, redeemed, redeemed_at ON coupons
+        BEGIN {_analytics_rollup('old', '-')} {_analytics_rollup('new', '+')} END
+    """)
+
+@migration
+def add_data_version(c):
+    """
+    Monotonic data version (and time of the last write), bumped by every
+    write path through bump_data_version(); drives ETag / Last-Modified.
+    """
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('data_version', 0)")
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('data_modified', ?)", (now_epoch(),))
+
+# Rollup triggers that must not fire when rows leave the coupons table for
+# the archive: stats and analytics keep counting archived coupons.
+NOT_ARCHIVING = "NOT EXISTS (SELECT 1 FROM maintenance_flags WHERE name = 'archiving')"
+
+@migration
+def add_archive_tombstones(c):
+    """
+    Tombstones for archived coupons (code -> STATUS_REDEEMED/STATUS_EXPIRED
+    and the archive partition holding the full row), so validation can
+    still answer for them and their codes are never handed out again.
+    The rollup delete triggers are recreated to skip archival deletes,
+    which are flagged through maintenance_flags.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS archived_codes (
+            code TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL,
+            partition TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE TABLE IF NOT EXISTS maintenance_flags (name TEXT PRIMARY KEY)")
+    c.execute("ALTER TABLE client_stats ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+    c.execute("DROP TRIGGER IF EXISTS client_stats_delete")
+    c.execute(f"""
+        CREATE TRIGGER client_stats_delete AFTER DELETE ON coupons
+        WHEN {NOT_ARCHIVING}
+        BEGIN {_client_stats_remove('old')} END
+    """)
+    c.execute("DROP TRIGGER IF EXISTS analytics_delete")
+    c.execute(f"""
+        CREATE TRIGGER analytics_delete AFTER DELETE ON coupons
+        WHEN {NOT_ARCHIVING}
+        BEGIN {_analytics_rollup('old', '-')} END
+    """)
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS coupons_reject_archived_code BEFORE INSERT ON coupons
+        WHEN EXISTS (SELECT 1 FROM archived_codes WHERE code = new.code)
+        BEGIN
+            SELECT RAISE(ABORT, 'UNIQUE constraint failed: coupon code is archived');
+        END
+    ''')
+
+def _coupon_status(row):
+    """SQL expression for a coupon row's materialized status."""
+    return f"""
+        CASE WHEN {row}.redeemed != 0 THEN 'redeemed'
+             WHEN {row}.expires_at < CAST(strftime('%s', 'now') AS INTEGER) THEN 'expired'
+             ELSE 'active' END
+    """
+
+@migration
+def add_status_column(c):
+    """
+    Materialized status (active / redeemed / expired), so listings filter
+    on an index instead of comparing every row's expires_at with the clock.
+    Redeeming or changing expires_at updates it through a trigger; time
+    passing is handled by sweep_expired, which finds its rows through the
+    partial index on active coupons' expiry.
+    """
+    c.execute("ALTER TABLE coupons ADD COLUMN status TEXT NOT NULL DEFAULT 'active'")
+    c.execute(f"""
+        UPDATE coupons SET status = CASE
+            WHEN redeemed != 0 THEN 'redeemed'
+            WHEN {EXPIRES_AT_EPOCH_SQL} < CAST(strftime('%s', 'now') AS INTEGER) THEN 'expired'
+            ELSE 'active' END
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_status ON coupons (status, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_active_expiry ON coupons (expires_at) WHERE status = 'active'")
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS coupons_status_update
+        AFTER UPDATE OF redeemed, expires_at ON coupons
+        BEGIN
+            UPDATE coupons SET status = {_coupon_status('new')} WHERE id = new.id;
+        END
+    """)
+    c.execute("ANALYZE coupons")
+
+def _code_sql(column):
+    """SQL expression turning a code_num column back into its code (inverse of code_index)."""
+    base = len(CODE_ALPHABET)
+    chars = [
+        f"substr('{CODE_ALPHABET}', {column} / {base ** power} % {base} + 1, 1)"
+        for power in reversed(range(CODE_LENGTH))
+    ]
+    return f"'{CODE_PREFIX}' || " + " || ".join(chars)
 
-def generate_coupon_code():
-    """Generates a short coupon code like VIPAB12."""
-    return "VIP" + ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
+@migration
+def pack_coupon_codes(c):
+    """
+    Stores codes as code_num (see code_index) under a UNIQUE integer index
+    instead of a UNIQUE TEXT one; codes outside the code space keep their
+    text in code_text. `code` stays readable as a virtual generated column,
+    so search, triggers, exports and templates are unchanged; lookups go
+    through code_condition. SQLite can't change a column in place, so the
+    table is rebuilt and its indexes and triggers recreated from their SQL.
+    """
+    c.connection.create_function('code_index', 1, code_index, deterministic=True)
+    saved = [sql for (sql,) in c.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'coupons' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ).fetchall()]
+    sequence = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'coupons'").fetchone()
+    c.execute(f'''
+        CREATE TABLE coupons_packed (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT,
+            code_num INTEGER,
+            code_text TEXT,
+            code TEXT GENERATED ALWAYS AS (COALESCE(code_text, {_code_sql('code_num')})) VIRTUAL,
+            created_at INTEGER,
+            expires_at INTEGER,
+            redeemed INTEGER DEFAULT 0,
+            domain TEXT,
+            client TEXT,
+            redeemed_at INTEGER,
+            status TEXT NOT NULL DEFAULT 'active'
+        )
+    ''')
+    c.execute('''
+        INSERT INTO coupons_packed (id, email, code_num, code_text, created_at, expires_at,
+                                    redeemed, domain, client, redeemed_at, status)
+        SELECT id, email, code_index(code), CASE WHEN code_index(code) IS NULL THEN code END,
+               created_at, expires_at, redeemed, domain, client, redeemed_at, status
+        FROM coupons
+    ''')
+    c.execute("DROP TABLE coupons")
+    c.execute("ALTER TABLE coupons_packed RENAME TO coupons")
+    if sequence:
+        c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'coupons'", sequence)
+    for sql in saved:
+        c.execute(sql)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_coupons_code_num ON coupons (code_num)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_coupons_code_text ON coupons (code_text) WHERE code_text IS NOT NULL")
+    c.execute("ANALYZE coupons")
+
+@migration
+def add_clients_table(c):
+    """
+    Interns client names: one clients row per name (case-insensitive, the
+    first spelling seen wins) with the client's defaults for new coupons,
+    and coupons.client_id pointing at it under an index, so the history
+    filter is an integer lookup. coupons.client keeps the client's name,
+    rewritten to its canonical spelling, for the rollups, search and exports.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS clients (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE COLLATE NOCASE,
+            domain TEXT,
+            expiry_days INTEGER,
+            created_at INTEGER
+        )
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO clients (name, created_at)
+        SELECT client, MIN(created_at) FROM coupons
+        WHERE client IS NOT NULL AND client != ''
+        GROUP BY client ORDER BY MIN(id)
+    ''')
+    c.execute("ALTER TABLE coupons ADD COLUMN client_id INTEGER REFERENCES clients (id)")
+    c.execute('''
+        UPDATE coupons SET client_id = (SELECT id FROM clients WHERE name = coupons.client)
+        WHERE client IS NOT NULL AND client != ''
+    ''')
+    c.execute('''
+        UPDATE coupons SET client = (SELECT name FROM clients WHERE id = coupons.client_id)
+        WHERE client_id IS NOT NULL AND client != (SELECT name FROM clients WHERE id = coupons.client_id)
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coupons_client_id_created_at ON coupons (client_id, created_at)")
+    c.execute("DROP INDEX IF EXISTS idx_coupons_client_created_at")
+    c.execute("ANALYZE coupons")
+
+def migrate(conn):
+    """
+    Applies pending migrations in order, one transaction each.
+    BEGIN IMMEDIATE takes SQLite's write lock before the version is read,
+    so concurrent workers wait for each other instead of migrating twice.
+    Returns the names of the migrations applied.
+    """
+    c = conn.cursor()
+    applied = []
+    for version, fn in enumerate(MIGRATIONS, start=1):
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            current = c.execute("PRAGMA user_version").fetchone()[0]
+            if current >= version:
+                conn.rollback()
+                continue
+            fn(c)
+            c.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(fn.__name__)
+    return applied
+
+def startup():
+    """
+    Brings the database and status map up to date (init_db) once for every
+    worker process sharing them: under an exclusive lock on a file next to
+    DATABASE, so workers starting together take turns and the later ones
+    find nothing left to do. Closes the connections it used, so none are
+    inherited by workers forked afterwards.
+    Returns the names of the migrations applied.
+    """
+    global _db_ready
+    with open(os.path.abspath(DATABASE) + '.lock', 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            applied = init_db()
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    close_db()
+    _db_ready = True
+    return applied
+
+def init_db():
+    """
+    Brings the database schema (every shard's, when sharded) up to date
+    and makes sure the status map exists.
+    """
+    applied = []
+    if shards:
+        shards.check()
+    for shard, path in enumerate(all_dbs()):
+        with get_db(path) as conn:
+            applied.extend(name for name in migrate(conn) if name not in applied)
+            if shards:
+                # Start the shard's ids at its own offset
+                offset = shard << SHARD_ID_BITS
+                conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'coupons'", (offset,))
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT 'coupons', ? "
+                    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'coupons')",
+                    (offset,)
+                )
+    if applied or not status_map.is_ready():
+        status_map.rebuild(get_db(path) for path in all_dbs())
+    return applied
+
+def bump_data_version(c):
+    """Marks the data as changed. Call inside the same transaction as the write."""
+    c.execute("UPDATE counters SET value = value + 1 WHERE name = 'data_version'")
+    c.execute("UPDATE counters SET value = ? WHERE name = 'data_modified'", (now_epoch(),))
+
+def read_data_version():
+    """
+    Returns (data version, epoch of the last write). When sharded, the
+    version is the sum of the shards' versions, which still only goes up.
+    """
+    version = modified = 0
+    for path in all_dbs():
+        with get_db(path) as conn:
+            c = conn.cursor()
+            c.execute("SELECT name, value FROM counters WHERE name IN ('data_version', 'data_modified')")
+            values = dict(c.fetchall())
+        version += values.get('data_version', 0)
+        modified = max(modified, values.get('data_modified', 0))
+    return version, modified
+
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
+def _store_page(key, body):
+    with _page_cache_lock:
+        _page_cache[key] = body
+        while len(_page_cache) > PAGE_CACHE_MAX_ENTRIES:
+            _page_cache.popitem(last=False)
+
+def _tee_into_page_cache(key, chunks):
+    """
+    Passes a streamed page through unchanged, keeping a copy for the page
+    cache unless it grows past PAGE_CACHE_MAX_BYTES or is cut short.
+    """
+    kept = []
+    size = 0
+    for chunk in chunks:
+        if kept is not None:
+            size += len(chunk)
+            if size <= PAGE_CACHE_MAX_BYTES:
+                kept.append(chunk)
+            else:
+                kept = None
+        yield chunk
+    if kept is not None:
+        _store_page(key, ''.join(kept))
+
+def conditional_page(time_dependent=False):
+    """
+    Decorator for listing views that return rendered HTML (a string, or
+    the chunk iterator from stream_template).
+    Answers 304 Not Modified when the client's ETag / Last-Modified still
+    matches the data version, and otherwise serves the page from a small
+    LRU keyed by (view, query string, version) before rendering it.
+    time_dependent is a bool or a function of request.args, for pages
+    whose content also changes with the clock.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            version, modified = read_data_version()
+            etag = f"v{version}"
+            if time_dependent is True or (callable(time_dependent) and time_dependent(request.args)):
+                bucket = now_epoch() // PAGE_TIME_BUCKET * PAGE_TIME_BUCKET
+                etag += f"-t{bucket}"
+                modified = max(modified, bucket)
+            last_modified = datetime.fromtimestamp(modified, timezone.utc)
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response('', 304)
+            else:
+                key = (request.endpoint, request.query_string, etag)
+                with _page_cache_lock:
+                    body = _page_cache.get(key)
+                    if body is not None:
+                        _page_cache.move_to_end(key)
+                if body is not None:
+                    response = make_response(body)
+                else:
+                    result = view(*args, **kwargs)
+                    if isinstance(result, str):
+                        _store_page(key, result)
+                        response = make_response(result)
+                    else:
+                        response = Response(_tee_into_page_cache(key, result), mimetype='text/html')
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Let browsers keep the page but always check back with us first
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+_db_ready = False
+_db_lock = threading.Lock()
+
+def configure(settings):
+    """
+    Applies the SETTINGS found in a mapping to the module, and rebuilds the
+    objects built from them (status map, shard catalog, shard pool). Caches
+    of the previous database's pages and states are dropped, and startup()
+    must run again before the next request.
+    """
+    global status_map, shards, _shard_pool, _db_ready
+    module = globals()
+    for name in SETTINGS:
+        if name in settings:
+            module[name] = settings[name]
+    _db_ready = False
+    close_db()
+    state_cache.clear()
+    with _page_cache_lock:
+        _page_cache.clear()
+    _dashboard_cache.clear()
+    status_map.close()
+    status_map = CodeStatusMap(STATUS_MAP_FILE)
+    shards = ShardCatalog(SHARD_FOLDER, SHARD_COUNT) if SHARD_COUNT else None
+    _shard_pool.shutdown(wait=False)
+    _shard_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(SHARD_COUNT, 1), thread_name_prefix='shard')
+
+def create_app(config=None):
+    """
+    Configures the app, brings the database up to date and returns the app.
+    For a WSGI server, e.g. in the PythonAnywhere WSGI file:
+        from app import create_app
+        application = create_app({'DATABASE': '/home/Luxtech/Coupon-gen/coupons.db'})
+    config is a mapping; COUPONS_<NAME> environment variables are read
+    first (values parsed as JSON where they can be), then config on top.
+    Keys in SETTINGS override the module's defaults; everything ends up in
+    app.config. Under `gunicorn --preload` this runs once, in the master,
+    before any worker accepts traffic; without it each worker runs it and
+    startup()'s lock makes them take turns. CLI commands get the same
+    configuration through `flask --app 'app:create_app()' <command>`.
+    """
+    app.config.from_prefixed_env('COUPONS')
+    if config:
+        app.config.update(config)
+    configure(app.config)
+    startup()
+    check_vendor_assets()
+    return app
+
+def _after_fork():
+    """
+    In a forked worker: drop the parent's SQLite connections and thread
+    pool, which must not be used across fork. Writer and sweeper threads
+    don't survive fork and restart on first use.
+    """
+    global _local, _shard_pool
+    _local = threading.local()
+    _shard_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(SHARD_COUNT, 1), thread_name_prefix='shard')
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+@app.before_request
+def ensure_db():
+    """
+    Runs startup() before the first request when the app wasn't built by
+    create_app (e.g. `flask run`), and makes sure this worker's expiry
+    sweeper is running: every forked worker needs its own.
+    """
+    if not _db_ready:
+        with _db_lock:
+            if not _db_ready:
+                startup()
+    start_expiry_sweeper()
+
+def sweep_expired(now=None):
+    """
+    Marks active coupons past their expires_at as expired, in chunks of
+    SWEEP_CHUNK_SIZE rows per write so redemptions never wait long behind
+    it. With nothing to expire this is one index probe.
+    Returns the number of coupons expired.
+    """
+    now = now_epoch() if now is None else now
+
+    def expire_chunk(c):
+        c.execute(
+            # Pinned to the partial index: idx_coupons_status would walk every active row
+            "SELECT id, code FROM coupons INDEXED BY idx_coupons_active_expiry "
+            "WHERE status = 'active' AND expires_at < ? LIMIT ?",
+            (now, SWEEP_CHUNK_SIZE)
+        )
+        rows = c.fetchall()
+        if rows:
+            placeholders = ",".join("?" * len(rows))
+            c.execute(f"UPDATE coupons SET status = 'expired' WHERE id IN ({placeholders})", [id_ for id_, _ in rows])
+            bump_data_version(c)
+        return [code for _, code in rows]
+
+    swept = 0
+    for path in all_dbs():
+        while True:
+            codes = writer_for(path).run(expire_chunk)
+            if not codes:
+                break
+            status_map.set_many((code, STATUS_EXPIRED) for code in codes)
+            swept += len(codes)
+    return swept
+
+def sweep_generated_csvs(max_age=None):
+    """
+    Deletes generated batch CSVs not written to for max_age seconds
+    (GENERATED_CSV_MAX_AGE by default). Returns the number deleted.
+    """
+    max_age = GENERATED_CSV_MAX_AGE if max_age is None else max_age
+    if not os.path.isdir(GENERATED_CSV_FOLDER):
+        return 0
+    cutoff = time.time() - max_age
+    deleted = 0
+    for entry in os.scandir(GENERATED_CSV_FOLDER):
+        if entry.name.startswith('coupons-') and entry.name.endswith('.csv'):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    deleted += 1
+            except FileNotFoundError:
+                # Another worker's sweeper got there first
+                pass
+    return deleted
+
+_sweeper_lock = threading.Lock()
+_sweeper_thread = None
+
+def _expiry_sweeper():
+    """Runs sweep_expired and sweep_generated_csvs every SWEEP_INTERVAL seconds."""
+    while True:
+        try:
+            sweep_expired()
+        except sqlite3.Error as e:
+            app.logger.warning("Expiry sweep failed: %s", e)
+        try:
+            sweep_generated_csvs()
+        except OSError as e:
+            app.logger.warning("Generated CSV sweep failed: %s", e)
+        time.sleep(SWEEP_INTERVAL)
+
+def start_expiry_sweeper():
+    """Starts this process's expiry sweeper thread, if it isn't running yet."""
+    global _sweeper_thread
+    if _sweeper_thread is not None and _sweeper_thread.is_alive():
+        return
+    with _sweeper_lock:
+        if _sweeper_thread is None or not _sweeper_thread.is_alive():
+            _sweeper_thread = threading.Thread(target=_expiry_sweeper, name='expiry-sweeper', daemon=True)
+            _sweeper_thread.start()
+
+def client_key(name):
+    """
+    A client name folded the way the clients table compares names
+    (COLLATE NOCASE: ASCII letters only).
+    """
+    return (name or '').encode('utf-8').lower()
+
+def generate_coupon_code(first_chars=None):
+    """
+    Generates a short coupon code like VIPAB12: CODE_PREFIX and CODE_LENGTH
+    characters from CODE_ALPHABET, so it round-trips through code_index.
+    first_chars limits the first of those (a shard's slice of the code space).
+    """
+    first = random.choice(first_chars or CODE_ALPHABET)
+    return CODE_PREFIX + first + ''.join(random.choices(CODE_ALPHABET, k=CODE_LENGTH - 1))
 
 def generate_qr_file(code):
     """
@@ -60,11 +1513,194 @@ def generate_qr_file(code):
     img.save(filepath)
     return filename
 
+_qr_cleanup_queue = queue.Queue()
+_qr_cleanup_lock = threading.Lock()
+_qr_cleanup_thread = None
+
+def _qr_cleanup_worker():
+    """Deletes the QR files of deleted coupons, one folder scan per batch of work."""
+    while True:
+        codes = set(_qr_cleanup_queue.get())
+        taken = 1
+        # Fold in everything else already queued so the folder is scanned once
+        while True:
+            try:
+                codes.update(_qr_cleanup_queue.get_nowait())
+                taken += 1
+            except queue.Empty:
+                break
+        try:
+            with os.scandir(STATIC_QR_FOLDER) as entries:
+                for entry in entries:
+                    # QR files are named <code>-<uuid>.png (see generate_qr_file)
+                    if entry.name.endswith('.png') and entry.name.split('-', 1)[0] in codes:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+        except OSError as e:
+            app.logger.warning("QR cleanup failed: %s", e)
+        for _ in range(taken):
+            _qr_cleanup_queue.task_done()
+
+def schedule_qr_cleanup(codes):
+    """Removes the QR files for these codes in a background thread."""
+    global _qr_cleanup_thread
+    codes = list(codes)
+    if not codes:
+        return
+    with _qr_cleanup_lock:
+        if _qr_cleanup_thread is None or not _qr_cleanup_thread.is_alive():
+            _qr_cleanup_thread = threading.Thread(target=_qr_cleanup_worker, name='qr-cleanup', daemon=True)
+            _qr_cleanup_thread.start()
+    _qr_cleanup_queue.put(codes)
+
+_asset_hashes = {}
+
+def asset_hash(filename):
+    """
+    Short content hash of a file in the static folder, or None if it's missing.
+    Cached per file modification time.
+    """
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _asset_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _asset_hashes[filename] = (mtime, digest)
+    return digest
+
+@app.template_global()
+def asset_url(filename):
+    """
+    URL for a static file with its content hash in the name,
+    e.g. style.css -> /assets/style.3f2a9c0d1b7e.css, served with immutable
+    cache headers. A vendored file that hasn't been committed yet falls back
+    to its pinned CDN URL (see check_vendor_assets).
+    """
+    digest = asset_hash(filename)
+    if digest is None:
+        if filename in VENDOR_ASSETS:
+            return VENDOR_ASSETS[filename]
+        return url_for('static', filename=filename)
+    stem, ext = os.path.splitext(filename)
+    return url_for('hashed_asset', filename=f"{stem}.{digest}{ext}")
+
+def check_vendor_assets():
+    """Logs a warning for each VENDOR_ASSETS file missing from Static/. Returns their names."""
+    missing = [
+        filename for filename in VENDOR_ASSETS
+        if not os.path.exists(os.path.join(app.static_folder, filename))
+    ]
+    for filename in missing:
+        app.logger.warning(
+            "Static/%s is missing, so pages load it from %s: run `flask vendor-assets` and commit it",
+            filename, VENDOR_ASSETS[filename]
+        )
+    return missing
+
+@app.route('/assets/<path:filename>')
+def hashed_asset(filename):
+    """Serves a static file by its content-hashed name (see asset_url)."""
+    match = HASHED_ASSET_RE.match(filename)
+    if not match:
+        abort(404)
+    real_name = match.group('stem') + match.group('ext')
+    # An old hash means old content we no longer have: don't cache it forever
+    if asset_hash(real_name) != match.group('hash'):
+        abort(404)
+    response = send_from_directory(app.static_folder, real_name, max_age=ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/sw.js')
+def service_worker():
+    """
+    Service worker that precaches the scanner pages and their assets, so the
+    scanner starts instantly on repeat visits and keeps working on a flaky
+    uplink. Served from the root so its scope covers the whole app.
+    """
+    precache = [
+        url_for('validate_coupon'),
+        url_for('kiosk'),
+        asset_url('style.css'),
+        asset_url('vendor/html5-qrcode.min.js'),
+    ]
+    cache_version = hashlib.sha256("\n".join(precache).encode()).hexdigest()[:12]
+    response = make_response(render_template("sw.js", precache=precache, cache_version=cache_version))
+    response.mimetype = 'application/javascript'
+    # Browsers must always see the latest list of hashed assets
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/')
 def index():
     """Home page."""
     return render_template("index.html")
 
+def mark_codes_created(codes):
+    """Updates the in-process cache and shared status map for newly inserted codes."""
+    # New codes may have been cached as "not found"
+    state_cache.invalidate(*codes)
+    status_map.set_many((code, STATUS_ACTIVE) for code in codes)
+
+def create_coupons(emails, client_name, csv_path):
+    """
+    Inserts one coupon per entry of emails (None for no email), writes its
+    QR file and its CSV line, and yields it for display as it goes.
+    Domain and expiry come from the client's defaults, if it has any.
+    Codes are allocated and rows stored through the store SQL_IN_CHUNK at a
+    time, and a chunk's CSV lines are written once it has landed, so the
+    CSV always matches the database and memory stays flat however many
+    are generated. The write lock is never held while QR files are drawn.
+    """
+    client = store.client(client_name)
+    if client:
+        client_name = client['name']
+    domain = client and client['domain'] or DEFAULT_DOMAIN
+    expiry_days = client and client['expiry_days'] or DEFAULT_EXPIRY_DAYS
+    now = now_epoch()
+    expires_at = now + int(timedelta(days=expiry_days).total_seconds())
+    emails = iter(emails)
+
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=GENERATED_CSV_FIELDS)
+        writer.writeheader()
+        while True:
+            chunk = list(itertools.islice(emails, SQL_IN_CHUNK))
+            if not chunk:
+                break
+            coupons = []
+            for email, code in zip(chunk, store.allocate(client_name, len(chunk))):
+                filename = generate_qr_file(code)
+                # Build the PythonAnywhere file manager link
+                # (not publicly accessible, but stored in CSV)
+                file_link = f"{FILE_MANAGER_URL}/{filename}"
+                coupon = {
+                    'email': email or '',
+                    'code': code,
+                    'qr_file': filename,
+                    'qr_link': file_link,
+                    'created_at': format_epoch(now),
+                    'expires_at': format_epoch(expires_at),
+                    'redeemed': 0,
+                    'client': client_name
+                }
+                coupons.append(coupon)
+                yield coupon
+            store.insert_bulk([
+                {'email': coupon['email'] or None, 'code': coupon['code'], 'client': client_name,
+                 'domain': domain, 'created_at': now, 'expires_at': expires_at}
+                for coupon in coupons
+            ])
+            writer.writerows(coupons)
+
 @app.route('/generate_coupons', methods=['GET', 'POST'])
 def generate_coupons():
     """
@@ -73,23 +1709,22 @@ def generate_coupons():
       - Or upload a CSV of emails
       - Optionally specify a client name
     Displays the generated coupons & provides a downloadable CSV.
+    The table is streamed row by row while the coupons are being created.
     If neither is provided, we show an error on the same page.
     """
-    coupons = []
-    csv_output = ""
     error_message = None
+    # Existing clients, suggested in the client field
+    clients = store.clients()
 
     if request.method == 'POST':
         file = request.files.get('file')
         count_str = request.form.get('count', '').strip()
         client_name = request.form.get('client', '').strip()
-        now = datetime.now()
-        expires_at = now + timedelta(days=30)
 
         # If user provided neither file nor count, show error on same page
         if (not file or file.filename == '') and (not count_str):
             error_message = "Please provide a CSV file or a number of coupons to generate."
-            return render_template("generate_coupons.html", coupons=None, error_message=error_message)
+            return render_template("generate_coupons.html", coupons=None, clients=clients, error_message=error_message)
 
         if file and file.filename != '':
             # CSV file
@@ -97,7 +1732,7 @@ def generate_coupons():
                 stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
             except Exception as e:
                 error_message = f"Error reading file: {str(e)}"
-                return render_template("generate_coupons.html", coupons=None, error_message=error_message)
+                return render_template("generate_coupons.html", coupons=None, clients=clients, error_message=error_message)
 
             reader = csv.reader(stream)
             emails = []
@@ -114,85 +1749,536 @@ def generate_coupons():
 
             if not emails:
                 error_message = "No emails found in the file."
-                return render_template("generate_coupons.html", coupons=None, error_message=error_message)
+                return render_template("generate_coupons.html", coupons=None, clients=clients, error_message=error_message)
 
-            with sqlite3.connect(DATABASE) as conn:
-                c = conn.cursor()
-                for email in emails:
-                    code = generate_coupon_code()
-                    c.execute(
-                        "INSERT INTO coupons (email, code, created_at, expires_at, domain, client) VALUES (?, ?, ?, ?, ?, ?)",
-                        (email, code, now, expires_at, DEFAULT_DOMAIN, client_name)
-                    )
-                    filename = generate_qr_file(code)
-                    # Build the PythonAnywhere file manager link
-                    # (not publicly accessible, but stored in CSV)
-                    file_link = f"{FILE_MANAGER_URL}/{filename}"
-                    coupons.append({
-                        'email': email,
-                        'code': code,
-                        'qr_file': filename,
-                        'qr_link': file_link,
-                        'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
-                        'expires_at': expires_at.strftime('%Y-%m-%d %H:%M:%S'),
-                        'redeemed': 0,
-                        'client': client_name
-                    })
-                conn.commit()
-
-        elif count_str:
+        else:
             # Numeric count
             try:
                 count = int(count_str)
             except ValueError:
                 error_message = "Invalid number"
-                return render_template("generate_coupons.html", coupons=None, error_message=error_message)
+                return render_template("generate_coupons.html", coupons=None, clients=clients, error_message=error_message)
+            emails = itertools.repeat(None, count)
+
+        os.makedirs(GENERATED_CSV_FOLDER, exist_ok=True)
+        csv_name = f"coupons-{uuid.uuid4().hex}.csv"
+        coupons = create_coupons(emails, client_name, os.path.join(GENERATED_CSV_FOLDER, csv_name))
+        return stream_template(
+            "generate_coupons.html", coupons=coupons, clients=clients,
+            csv_url=url_for('generated_csv', filename=csv_name), error_message=None
+        )
+
+    # GET request
+    return render_template("generate_coupons.html", coupons=None, clients=clients, error_message=None)
+
+@app.route('/generated/<filename>')
+def generated_csv(filename):
+    """Downloads the CSV written for a generated batch (kept for GENERATED_CSV_MAX_AGE)."""
+    return send_from_directory(GENERATED_CSV_FOLDER, filename, as_attachment=True, download_name='coupons.csv')
+
+def archived_states(c, codes):
+    """Final state ('redeemed' / 'expired') of any of these codes that were archived."""
+    states = {}
+    for start in range(0, len(codes), SQL_IN_CHUNK):
+        chunk = codes[start:start + SQL_IN_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        c.execute(f"SELECT code, status FROM archived_codes WHERE code IN ({placeholders})", chunk)
+        for code, status in c.fetchall():
+            states[code] = STATUS_MAP_STATES[status]
+    return states
+
+class CouponStore(abc.ABC):
+    """
+    Where coupons live. The routes' hot paths go through these methods, so
+    backends can be swapped (SQLiteCouponStore in the app, MemoryCouponStore
+    for tests and benchmarks) and every call is timed in one place:
+      allocate(client_name, count)   -> that many unused codes for the client
+      insert_bulk(coupons)           -> stores dicts of email, code, client,
+                                        domain, created_at, expires_at
+      redeem(code)                   -> 'valid' | 'redeemed' | 'expired' | 'not_found'
+      list(filters, sort, descending, cursor, limit)
+                                     -> coupon dicts after the (sort value, id)
+                                        cursor, produced lazily
+      delete(codes)                  -> number of coupons deleted
+      count(client_name)             -> coupons in total or for one client
+      stats()                        -> per-client counts (see load_client_stats)
+      client(name)                   -> a client's id, name and defaults, or None
+      clients()                      -> every client, by name
+      save_client(name, domain, expiry_days)
+                                     -> creates a client or updates its defaults
+    Client names are compared case-insensitively (see client_key); new
+    clients are created by insert_bulk. Backends implement the underscored
+    versions.
+    """
 
-            with sqlite3.connect(DATABASE) as conn:
+    def __init__(self):
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def _record(self, name, seconds):
+        with self._metrics_lock:
+            calls, total, slowest = self._metrics.get(name, (0, 0.0, 0.0))
+            self._metrics[name] = (calls + 1, total + seconds, max(slowest, seconds))
+
+    def _timed(self, name, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def metrics(self):
+        """Calls, total / average / slowest time in ms, per operation."""
+        with self._metrics_lock:
+            return {
+                name: {
+                    'calls': calls,
+                    'total_ms': round(total * 1000, 3),
+                    'avg_ms': round(total / calls * 1000, 4),
+                    'max_ms': round(slowest * 1000, 3),
+                }
+                for name, (calls, total, slowest) in sorted(self._metrics.items())
+            }
+
+    def reset_metrics(self):
+        with self._metrics_lock:
+            self._metrics.clear()
+
+    def allocate(self, client_name, count):
+        return self._timed('allocate', self._allocate, client_name, count)
+
+    def insert_bulk(self, coupons):
+        return self._timed('insert_bulk', self._insert_bulk, coupons)
+
+    def redeem(self, code):
+        return self._timed('redeem', self._redeem, code)
+
+    def list(self, filters, sort='id', descending=True, cursor=None, limit=HISTORY_PAGE_SIZE):
+        """Only the time spent producing rows is counted, not the caller's."""
+        rows = self._list(filters, sort, descending, cursor, limit)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield row
+        finally:
+            rows.close()
+            self._record('list', elapsed)
+
+    def delete(self, codes):
+        return self._timed('delete', self._delete, list(codes))
+
+    def count(self, client_name=''):
+        return self._timed('count', self._count, client_name)
+
+    def stats(self):
+        return self._timed('stats', self._stats)
+
+    def client(self, name):
+        return self._timed('client', self._client, name)
+
+    def clients(self):
+        return self._timed('clients', self._clients)
+
+    def save_client(self, name, domain=None, expiry_days=None):
+        return self._timed('save_client', self._save_client, name, domain, expiry_days)
+
+    @abc.abstractmethod
+    def _allocate(self, client_name, count):
+        pass
+
+    @abc.abstractmethod
+    def _insert_bulk(self, coupons):
+        pass
+
+    @abc.abstractmethod
+    def _redeem(self, code):
+        pass
+
+    @abc.abstractmethod
+    def _list(self, filters, sort, descending, cursor, limit):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, codes):
+        pass
+
+    @abc.abstractmethod
+    def _count(self, client_name):
+        pass
+
+    @abc.abstractmethod
+    def _stats(self):
+        pass
+
+    @abc.abstractmethod
+    def _client(self, name):
+        pass
+
+    @abc.abstractmethod
+    def _clients(self):
+        pass
+
+    @abc.abstractmethod
+    def _save_client(self, name, domain, expiry_days):
+        pass
+
+def draw_codes(count, first_chars, taken):
+    """
+    Draws count distinct random codes for which taken(candidates) doesn't
+    report a clash (taken returns the subset already in use).
+    """
+    codes = set()
+    for _ in range(ALLOCATE_MAX_ROUNDS):
+        wanted = count - len(codes)
+        if wanted <= 0:
+            break
+        candidates = {generate_coupon_code(first_chars) for _ in range(wanted)} - codes
+        codes |= candidates - taken(candidates)
+    if len(codes) < count:
+        raise RuntimeError(f"Could only find {len(codes)} of {count} unused coupon codes")
+    return list(codes)
+
+class SQLiteCouponStore(CouponStore):
+    """
+    The app's store: coupons in SQLite (DATABASE, or the client's shard),
+    with the state cache and the shared status map in front of lookups,
+    and every write through the database's WriteQueue.
+    """
+
+    def _allocate(self, client_name, count):
+        path = client_db(client_name)
+        first_chars = shards.prefixes(shards.for_client(client_name)) if shards else CODE_ALPHABET
+
+        def taken(candidates):
+            candidates = list(candidates)
+            found = set()
+            with get_db(path) as conn:
                 c = conn.cursor()
-                for _ in range(count):
-                    code = generate_coupon_code()
-                    c.execute(
-                        "INSERT INTO coupons (email, code, created_at, expires_at, domain, client) VALUES (?, ?, ?, ?, ?, ?)",
-                        (None, code, now, expires_at, DEFAULT_DOMAIN, client_name)
-                    )
-                    filename = generate_qr_file(code)
-                    file_link = f"{FILE_MANAGER_URL}/{filename}"
-                    coupons.append({
-                        'email': '',
-                        'code': code,
-                        'qr_file': filename,
-                        'qr_link': file_link,
-                        'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
-                        'expires_at': expires_at.strftime('%Y-%m-%d %H:%M:%S'),
-                        'redeemed': 0,
-                        'client': client_name
-                    })
-                conn.commit()
+                for start in range(0, len(candidates), SQL_IN_CHUNK):
+                    where, params = code_condition(candidates[start:start + SQL_IN_CHUNK])
+                    c.execute(f"SELECT code FROM coupons WHERE {where}", params)
+                    found.update(row[0] for row in c.fetchall())
+                found.update(archived_states(c, candidates))
+            return found
+        return draw_codes(count, first_chars, taken)
 
-        # Build CSV
-        output = io.StringIO()
-        fieldnames = ['email', 'code', 'qr_file', 'qr_link', 'created_at', 'expires_at', 'redeemed', 'client']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
+    def _insert_bulk(self, coupons):
+        by_db = {}
         for coupon in coupons:
-            writer.writerow({
-                'email': coupon['email'],
-                'code': coupon['code'],
-                'qr_file': coupon['qr_file'],
-                'qr_link': coupon['qr_link'],
-                'created_at': coupon['created_at'],
-                'expires_at': coupon['expires_at'],
-                'redeemed': coupon['redeemed'],
-                'client': coupon['client']
-            })
-        csv_output = output.getvalue()
-        output.close()
+            by_db.setdefault(client_db(coupon['client']), []).append(coupon)
 
-        return render_template("generate_coupons.html", coupons=coupons, csv_data=csv_output, error_message=None)
+        def insert(db_coupons):
+            def op(c):
+                # Interns each client name once per call: (id, canonical name)
+                clients = {'': (None, '')}
+                for coupon in db_coupons:
+                    name = coupon['client'] or ''
+                    if name not in clients:
+                        c.execute("INSERT OR IGNORE INTO clients (name, created_at) VALUES (?, ?)", (name, now_epoch()))
+                        c.execute("SELECT id, name FROM clients WHERE name = ?", (name,))
+                        clients[name] = c.fetchone()
+                c.executemany(
+                    "INSERT INTO coupons (email, code_num, code_text, created_at, expires_at, domain, client_id, client) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (coupon['email'], *code_columns(coupon['code']), coupon['created_at'],
+                         coupon['expires_at'], coupon['domain'], *clients[coupon['client'] or ''])
+                        for coupon in db_coupons
+                    ]
+                )
+                bump_data_version(c)
+            return op
 
-    # GET request
-    return render_template("generate_coupons.html", coupons=None, error_message=None)
+        for path, db_coupons in by_db.items():
+            writer_for(path).run(insert(db_coupons))
+            mark_codes_created([coupon['code'] for coupon in db_coupons])
+        return len(coupons)
+
+    def _redeem(self, code):
+        state = state_cache.get(code)
+        mapped = status_map.get(code)
+        if state and mapped is not None and STATUS_MAP_STATES.get(mapped) != state:
+            # Another worker changed the code since we cached it
+            state_cache.invalidate(code)
+            state = None
+        if not state:
+            state = STATUS_MAP_STATES.get(mapped)
+        if state:
+            return state
+        path = code_db(code)
+        with get_db(path) as conn:
+            c = conn.cursor()
+            now = now_epoch()
+            where, params = code_condition([code])
+            c.execute(f"SELECT id, redeemed, ({EXPIRES_AT_EPOCH_SQL}) < ? FROM coupons WHERE {where}", [now] + params)
+            result = c.fetchone()
+            if not result:
+                state = archived_states(c, [code]).get(code, 'not_found')
+                state_cache.put(code, state)
+                return state
+            id_, redeemed, expired = result
+            if redeemed:
+                state_cache.put(code, 'redeemed')
+                return 'redeemed'
+            if expired:
+                status_map.set(code, STATUS_EXPIRED)
+                return 'expired'
+
+        def redeem(c):
+            # redeemed=0 guard: two tills scanning the same code at once
+            c.execute("UPDATE coupons SET redeemed=1, redeemed_at=? WHERE id=? AND redeemed=0", (now, id_))
+            if c.rowcount:
+                bump_data_version(c)
+            return c.rowcount
+
+        state = 'valid' if writer_for(path).run(redeem) else 'redeemed'
+        state_cache.put(code, 'redeemed')
+        status_map.set(code, STATUS_REDEEMED)
+        return state
+
+    def _list(self, filters, sort, descending, cursor, limit):
+        where, params = filter_sql(filters)
+        direction = 'DESC' if descending else 'ASC'
+        # Codes sort by their indexed code_num, i.e. in CODE_ALPHABET order
+        sort_column = 'code_num' if sort == 'code' else sort
+        if cursor:
+            where.append(f"({sort_column}, id) {'<' if descending else '>'} (?, ?)")
+            params.extend(cursor)
+        sql = "SELECT id, code, email, redeemed, status, domain, client, created_at, expires_at, code_num FROM coupons"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {sort_column} {direction}, id {direction} LIMIT ?"
+        params.append(limit)
+        paths = [client_db(filters['client'])] if filters['client'] else all_dbs()
+
+        if len(paths) == 1:
+            c = get_db(paths[0]).cursor()
+            try:
+                c.execute(sql, params)
+                for row in c:
+                    yield dict(zip(LIST_FIELDS, row))
+            finally:
+                c.close()
+            return
+
+        def fetch(path):
+            with get_db(path) as conn:
+                return [dict(zip(LIST_FIELDS, row)) for row in conn.execute(sql, params)]
+        # Each shard sends at most limit rows; ids never repeat across shards
+        yield from heapq.merge(*fan_out(fetch, paths), key=functools.partial(list_key, sort=sort), reverse=descending)
+
+    def _delete(self, codes):
+        by_db = {}
+        for code in codes:
+            by_db.setdefault(code_db(code), []).append(code)
+
+        def delete(db_codes):
+            def op(c):
+                deleted = 0
+                for start in range(0, len(db_codes), SQL_IN_CHUNK):
+                    where, params = code_condition(db_codes[start:start + SQL_IN_CHUNK])
+                    c.execute(f"DELETE FROM coupons WHERE {where}", params)
+                    deleted += c.rowcount
+                if deleted:
+                    bump_data_version(c)
+                return deleted
+            return op
+
+        deleted = sum(writer_for(path).run(delete(db_codes)) for path, db_codes in by_db.items())
+        state_cache.invalidate(*codes)
+        status_map.set_many((code, STATUS_ABSENT) for code in codes)
+        schedule_qr_cleanup(codes)
+        return deleted
+
+    def _count(self, client_name):
+        return count_coupons(client_name)
+
+    def _stats(self):
+        return load_client_stats()
+
+    def _client(self, name):
+        if not name:
+            return None
+        with get_db(client_db(name)) as conn:
+            row = conn.execute(f"SELECT {', '.join(CLIENT_FIELDS)} FROM clients WHERE name = ?", (name,)).fetchone()
+        return dict(zip(CLIENT_FIELDS, row)) if row else None
+
+    def _clients(self):
+        def read(path):
+            with get_db(path) as conn:
+                rows = conn.execute(f"SELECT {', '.join(CLIENT_FIELDS)} FROM clients ORDER BY name").fetchall()
+            return [dict(zip(CLIENT_FIELDS, row)) for row in rows]
+        return list(heapq.merge(*fan_out(read), key=lambda client: client_key(client['name'])))
+
+    def _save_client(self, name, domain, expiry_days):
+        def save(c):
+            c.execute(
+                "INSERT INTO clients (name, domain, expiry_days, created_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET domain = excluded.domain, expiry_days = excluded.expiry_days",
+                (name, domain, expiry_days, now_epoch())
+            )
+            bump_data_version(c)
+        writer_for(client_db(name)).run(save)
+        return self._client(name)
+
+def list_key(row, sort):
+    """A listed coupon's (sort value, id), ordered the way SQLite orders them (NULLs first)."""
+    value = row['code_num'] if sort == 'code' else row[sort]
+    return (value is not None, value if value is not None else 0, row['id'])
+
+class MemoryCouponStore(CouponStore):
+    """
+    Coupons in a dict, for tests and benchmarks: the same answers as
+    SQLiteCouponStore for these operations, without persistence, caches
+    or shards. Listing and stats scan every coupon.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._coupons = {}
+        self._next_id = 1
+        self._clients_by_key = {}
+
+    @staticmethod
+    def _status(row, now):
+        if row['redeemed']:
+            return 'redeemed'
+        if row['expires_at'] is not None and row['expires_at'] < now:
+            return 'expired'
+        return 'active'
+
+    def _allocate(self, client_name, count):
+        def taken(candidates):
+            with self._lock:
+                return {code for code in candidates if code in self._coupons}
+        return draw_codes(count, CODE_ALPHABET, taken)
+
+    def _intern_client(self, name):
+        """The client for a name, created if it's new (hold self._lock)."""
+        key = client_key(name)
+        if key not in self._clients_by_key:
+            self._clients_by_key[key] = {
+                'id': len(self._clients_by_key) + 1, 'name': name, 'domain': None, 'expiry_days': None,
+            }
+        return self._clients_by_key[key]
+
+    def _insert_bulk(self, coupons):
+        with self._lock:
+            codes = [coupon['code'] for coupon in coupons]
+            if len(set(codes)) != len(codes) or any(code in self._coupons for code in codes):
+                raise ValueError("Coupon code already exists")
+            for coupon in coupons:
+                client = self._intern_client(coupon['client']) if coupon['client'] else None
+                self._coupons[coupon['code']] = {
+                    'id': self._next_id,
+                    'code': coupon['code'],
+                    'email': coupon['email'],
+                    'redeemed': 0,
+                    'domain': coupon['domain'],
+                    'client': client['name'] if client else '',
+                    'client_id': client['id'] if client else None,
+                    'created_at': coupon['created_at'],
+                    'expires_at': coupon['expires_at'],
+                    'redeemed_at': None,
+                    'code_num': code_index(coupon['code']),
+                }
+                self._next_id += 1
+        return len(coupons)
+
+    def _redeem(self, code):
+        now = now_epoch()
+        with self._lock:
+            row = self._coupons.get(code)
+            if row is None:
+                return 'not_found'
+            state = self._status(row, now)
+            if state != 'active':
+                return state
+            row['redeemed'] = 1
+            row['redeemed_at'] = now
+            return 'valid'
+
+    def _list(self, filters, sort, descending, cursor, limit):
+        now = now_epoch()
+        with self._lock:
+            rows = [dict(row, status=self._status(row, now)) for row in self._coupons.values()]
+        date_field = filters['date_field']
+        rows = [
+            row for row in rows
+            if (not filters['client'] or client_key(row['client']) == client_key(filters['client']))
+            and (not filters['status'] or row['status'] == filters['status'])
+            # Like SQL, a missing date never matches a date bound
+            and (filters['since'] is None or (row[date_field] is not None and row[date_field] >= filters['since']))
+            and (filters['until'] is None or (row[date_field] is not None and row[date_field] < filters['until']))
+        ]
+        if cursor:
+            bound = (cursor[0] is not None, cursor[0] if cursor[0] is not None else 0, cursor[1])
+            rows = [
+                row for row in rows
+                if (list_key(row, sort) < bound if descending else list_key(row, sort) > bound)
+            ]
+        rows.sort(key=functools.partial(list_key, sort=sort), reverse=descending)
+        for row in rows[:limit]:
+            yield {field: row[field] for field in LIST_FIELDS}
+
+    def _delete(self, codes):
+        with self._lock:
+            return sum(self._coupons.pop(code, None) is not None for code in set(codes))
+
+    def _count(self, client_name):
+        with self._lock:
+            return sum(
+                1 for row in self._coupons.values()
+                if not client_name or client_key(row['client']) == client_key(client_name)
+            )
+
+    def _stats(self):
+        now = now_epoch()
+        per_client = {}
+        with self._lock:
+            for row in self._coupons.values():
+                counts = per_client.setdefault(row['client'] or '', {'issued': 0, 'redeemed': 0, 'expired': 0})
+                counts['issued'] += 1
+                state = self._status(row, now)
+                if state != 'active':
+                    counts[state] += 1
+        return [
+            {
+                'client': client,
+                'issued': counts['issued'],
+                'redeemed': counts['redeemed'],
+                'expired': counts['expired'],
+                'archived': 0,
+                'active': counts['issued'] - counts['redeemed'] - counts['expired'],
+                'redemption_rate': round(counts['redeemed'] / counts['issued'], 4),
+            }
+            for client, counts in sorted(per_client.items())
+        ]
+
+    def _client(self, name):
+        with self._lock:
+            client = self._clients_by_key.get(client_key(name)) if name else None
+            return dict(client) if client else None
+
+    def _clients(self):
+        with self._lock:
+            return [dict(client) for _, client in sorted(self._clients_by_key.items())]
+
+    def _save_client(self, name, domain, expiry_days):
+        with self._lock:
+            client = self._intern_client(name)
+            client.update(domain=domain, expiry_days=expiry_days)
+            return dict(client)
+
+store = SQLiteCouponStore()
 
 @app.route('/validate_coupon', methods=['GET', 'POST'])
 def validate_coupon():
@@ -203,61 +2289,1088 @@ def validate_coupon():
     message = None
     if request.method == 'POST':
         code = request.form['code']
-        with sqlite3.connect(DATABASE) as conn:
+        message = STATE_MESSAGES[store.redeem(code)]
+    return render_template("validate_coupon.html", message=message)
+
+@app.route('/kiosk')
+def kiosk():
+    """
+    Continuous scan mode for door staff: the camera keeps running and each
+    scan is redeemed through /api/redeem without reloading the page.
+    """
+    return render_template("kiosk.html")
+
+@app.route('/api/redeem', methods=['POST'])
+def api_redeem():
+    """
+    JSON version of validate_coupon for the kiosk.
+    Expects {"code": ...}; returns {"code", "status", "message"}.
+    """
+    payload = request.get_json(silent=True)
+    code = str(payload.get('code') or '').strip() if isinstance(payload, dict) else ''
+    if not code:
+        return jsonify({'error': 'Expected a JSON body like {"code": "VIPAB12"}.'}), 400
+    status = store.redeem(code)
+    return jsonify({'code': code, 'status': status, 'message': STATE_MESSAGES[status]})
+
+def parse_scan_time(value):
+    """
+    Parses a scanned_at value sent by a scanner.
+    Accepts an ISO 8601 string (local time unless it carries an offset)
+    or a UNIX timestamp in seconds or milliseconds.
+    Returns epoch seconds, or None if the value can't be understood or is
+    outside SCAN_TIME_RANGE.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            return None
+        epoch = value / 1000 if value > SCAN_TIME_MS_THRESHOLD else value
+    elif isinstance(value, str) and value.strip():
+        try:
+            epoch = datetime.fromisoformat(value.strip()).timestamp()
+        except (ValueError, OverflowError, OSError):
+            return None
+    else:
+        return None
+    low, high = SCAN_TIME_RANGE
+    return int(epoch) if low <= epoch < high else None
+
+@app.route('/sync_redemptions', methods=['POST'])
+def sync_redemptions():
+    """
+    Redeems a batch of scans queued by offline scanners, in one transaction
+    (one per shard, when sharded).
+    Expects JSON: {"scans": [{"code": ..., "scanned_at": ..., "device_id": ...}, ...]}
+    When the same code was scanned more than once, the earliest scan wins and
+    the others are reported as duplicates. Expiry is checked against the time
+    of the scan, not the time of the sync.
+    Returns one result per scan, in the order they were sent.
+    """
+    payload = request.get_json(silent=True)
+    scans = payload.get('scans') if isinstance(payload, dict) else None
+    if not isinstance(scans, list):
+        return jsonify({'error': 'Expected a JSON body like {"scans": [...]}.'}), 400
+    if len(scans) > MAX_SYNC_BATCH:
+        return jsonify({'error': f"Too many scans in one batch (max {MAX_SYNC_BATCH})."}), 413
+
+    results = [None] * len(scans)
+    valid = []
+    for i, scan in enumerate(scans):
+        scan = scan if isinstance(scan, dict) else {}
+        code = str(scan.get('code') or '').strip()
+        device_id = scan.get('device_id')
+        scanned_at = parse_scan_time(scan.get('scanned_at'))
+        results[i] = {'code': code, 'device_id': device_id}
+        if not code or scanned_at is None:
+            results[i].update(status='invalid', message="Missing code or unreadable scanned_at.")
+        else:
+            valid.append((scanned_at, i, code))
+
+    # Earliest scan first, so the first time we see a code is the winning scan
+    valid.sort()
+
+    def apply_scans(c, shard_scans):
+        """Runs on the shard's writer, so the lookups and updates are one snapshot."""
+        codes = list({code for _, _, code in shard_scans})
+        existing = {}
+        for start in range(0, len(codes), SQL_IN_CHUNK):
+            where, params = code_condition(codes[start:start + SQL_IN_CHUNK])
+            c.execute(f"SELECT code, {EXPIRES_AT_EPOCH_SQL}, redeemed, id FROM coupons WHERE {where}", params)
+            for code, expires_at, redeemed, id_ in c.fetchall():
+                existing[code] = (expires_at, redeemed, id_)
+        archived = archived_states(c, [code for code in codes if code not in existing])
+
+        seen = set()
+        updates = []
+        rows = []
+        for scanned_at, i, code in shard_scans:
+            result = results[i]
+            result['scanned_at'] = format_epoch(scanned_at)
+            if archived.get(code) == 'redeemed':
+                result.update(status='already_redeemed', message=STATE_MESSAGES['redeemed'])
+            elif archived.get(code) == 'expired':
+                result.update(status='expired', message=STATE_MESSAGES['expired'])
+            elif code not in existing:
+                result.update(status='not_found', message=STATE_MESSAGES['not_found'])
+            elif existing[code][1]:
+                # Redeemed before this sync, so no scan in the batch can claim it
+                result.update(status='already_redeemed', message=STATE_MESSAGES['redeemed'])
+            elif code in seen:
+                result.update(status='duplicate', message="An earlier scan already redeemed this coupon.")
+            # A NULL expiry (unparseable legacy text) never expires, as in store.redeem
+            elif existing[code][0] is not None and existing[code][0] < scanned_at:
+                result.update(status='expired', message="This coupon had expired when it was scanned.")
+            else:
+                result.update(status='redeemed', message=STATE_MESSAGES['valid'])
+                updates.append((scanned_at, code))
+                rows.append((scanned_at, existing[code][2]))
+                seen.add(code)
+
+        c.executemany("UPDATE coupons SET redeemed=1, redeemed_at=? WHERE id=? AND redeemed=0", rows)
+        if updates:
+            bump_data_version(c)
+        return updates
+
+    by_db = {}
+    for scan in valid:
+        by_db.setdefault(code_db(scan[2]), []).append(scan)
+    # One op per database, so shards apply their scans at the same time
+    futures = [
+        writer_for(path).submit(functools.partial(apply_scans, shard_scans=shard_scans))
+        for path, shard_scans in by_db.items()
+    ]
+    updates = [update for future in futures for update in future.result()]
+    for _, code in updates:
+        state_cache.put(code, 'redeemed')
+    status_map.set_many((code, STATUS_REDEEMED) for _, code in updates)
+
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return jsonify({'results': results, 'summary': summary})
+
+def encode_cursor(values):
+    """Packs a (sort value, id) pair into an opaque URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Reverses encode_cursor. Returns None for a missing or mangled cursor."""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    # Both end up as SQL parameters: a scalar sort value and an integer id
+    sort_value, id_ = values
+    if not isinstance(sort_value, (int, float, str, type(None))) or type(id_) is not int:
+        return None
+    return values
+
+def count_coupons(client_name):
+    """
+    Total number of coupons, optionally for one client.
+    Both come from trigger-maintained tables (counters / client_stats),
+    so this never runs COUNT(*). Archived coupons are not counted.
+    """
+    def count(path):
+        with get_db(path) as conn:
             c = conn.cursor()
-            c.execute("SELECT expires_at, redeemed FROM coupons WHERE code=?", (code,))
-            result = c.fetchone()
-            if result:
-                expires_at_str, redeemed = result
-                expires_at = datetime.strptime(expires_at_str, '%Y-%m-%d %H:%M:%S.%f')
-                if redeemed:
-                    message = "This coupon has already been redeemed."
-                elif expires_at < datetime.now():
-                    message = "This coupon has expired."
-                else:
-                    message = "This coupon is valid and now redeemed!"
-                    c.execute("UPDATE coupons SET redeemed=1 WHERE code=?", (code,))
-                    conn.commit()
+            if not client_name:
+                c.execute("SELECT value FROM counters WHERE name = 'coupons'")
             else:
-                message = "Coupon code not found."
-    return render_template("validate_coupon.html", message=message)
+                c.execute(
+                    "SELECT issued - archived FROM client_stats WHERE client = (SELECT name FROM clients WHERE name = ?)",
+                    (client_name,)
+                )
+            row = c.fetchone()
+        return row[0] if row else 0
+    return sum(fan_out(count, [client_db(client_name)] if client_name else None))
+
+def load_client_stats():
+    """
+    Issued / redeemed / expired / active counts per client, read from the
+    rollup tables (O(clients + batches), independent of the coupon count).
+    Counts include archived coupons; 'archived' says how many of them that is.
+    """
+    now = now_epoch()
+
+    def read(path):
+        with get_db(path) as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT s.client, s.issued, s.redeemed, COALESCE(e.expired, 0), s.archived
+                FROM client_stats s
+                LEFT JOIN (
+                    SELECT client, SUM(pending) AS expired
+                    FROM client_expiry WHERE expires_at < ? GROUP BY client
+                ) e ON e.client = s.client
+                ORDER BY s.client
+            ''', (now,))
+            return c.fetchall()
+
+    stats = []
+    # A client lives in a single shard, so the shards' rows never overlap
+    for client, issued, redeemed, expired, archived in heapq.merge(*fan_out(read)):
+        stats.append({
+            'client': client,
+            'issued': issued,
+            'redeemed': redeemed,
+            'expired': expired,
+            'archived': archived,
+            'active': issued - redeemed - expired,
+            'redemption_rate': round(redeemed / issued, 4) if issued else 0.0,
+        })
+    return stats
+
+@app.route('/stats')
+@conditional_page(time_dependent=True)
+def stats():
+    """Per-client issued / redeemed / expired counts."""
+    client_stats = load_client_stats()
+    totals = {key: sum(row[key] for row in client_stats) for key in ('issued', 'redeemed', 'expired', 'active', 'archived')}
+    return render_template("stats.html", stats=client_stats, totals=totals)
+
+@app.route('/clients', methods=['GET', 'POST'])
+def clients():
+    """
+    Lists clients and sets their defaults for new coupons (domain, expiry
+    days). Saving a name that doesn't exist yet creates the client.
+    """
+    error_message = None
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        domain = request.form.get('domain', '').strip() or None
+        expiry_days = request.form.get('expiry_days', '').strip()
+        try:
+            expiry_days = int(expiry_days) if expiry_days else None
+        except ValueError:
+            expiry_days = 0
+        if not name:
+            error_message = "Please enter a client name."
+        elif expiry_days is not None and expiry_days <= 0:
+            error_message = "Expiry must be a whole number of days."
+        else:
+            store.save_client(name, domain, expiry_days)
+            return redirect(url_for('clients'))
+    return render_template(
+        "clients.html", clients=store.clients(), error_message=error_message,
+        default_domain=DEFAULT_DOMAIN, default_expiry_days=DEFAULT_EXPIRY_DAYS
+    )
+
+@app.route('/api/stats')
+def api_stats():
+    """JSON version of /stats."""
+    client_stats = load_client_stats()
+    return jsonify({'clients': client_stats})
+
+_dashboard_cache = {}
+
+def build_dashboard_charts():
+    """
+    Builds the dashboard's Plotly figures (as JSON strings) from the rollup
+    tables only (every shard's, added up). pandas/plotly are imported here
+    so workers that never serve the dashboard don't pay for loading them.
+    """
+    import pandas as pd
+    import plotly.express as px
+
+    def read_sql(sql, params=()):
+        """Runs a query on every database and stacks the results in one DataFrame."""
+        return pd.concat(
+            fan_out(lambda path: pd.read_sql_query(sql, get_db(path), params=params)),
+            ignore_index=True
+        )
+
+    charts = {}
+    since_hour = (now_epoch() // 3600 - DASHBOARD_HOURLY_WINDOW) * 3600
+
+    hourly = read_sql(
+        "SELECT hour, SUM(issued) AS issued, SUM(redeemed) AS redeemed FROM hourly_stats GROUP BY hour"
+    ).groupby('hour', as_index=False).sum()
+    hourly['time'] = pd.to_datetime(hourly['hour'], unit='s', utc=True).dt.tz_convert(None)
+    recent = hourly[hourly['hour'] >= since_hour]
+    charts['per_hour'] = px.bar(
+        recent, x='time', y='redeemed', title='Redemptions per hour (last 7 days)',
+        labels={'time': 'Hour (UTC)', 'redeemed': 'Redemptions'}
+    ).to_json()
+    daily = hourly.set_index('time')[['issued', 'redeemed']].resample('D').sum().reset_index()
+    charts['per_day'] = px.line(
+        daily, x='time', y=['issued', 'redeemed'], title='Coupons issued and redeemed per day',
+        labels={'time': 'Day (UTC)', 'value': 'Coupons', 'variable': ''}
+    ).to_json()
+
+    clients = pd.DataFrame(load_client_stats())
+    if clients.empty:
+        clients = pd.DataFrame(columns=['client', 'redemption_rate'])
+    clients['client'] = clients['client'].replace('', 'N/A')
+    charts['per_client'] = px.bar(
+        clients, x='client', y='redemption_rate', title='Redemption rate per client',
+        labels={'client': 'Client', 'redemption_rate': 'Redemption rate'}
+    ).update_yaxes(tickformat='.0%').to_json()
+
+    batches = read_sql(
+        "SELECT client, created_at, issued, redeemed FROM batch_stats "
+        "WHERE issued > 0 ORDER BY created_at DESC LIMIT ?",
+        (DASHBOARD_MAX_BATCHES,)
+    ).sort_values('created_at', ascending=False, kind='stable').head(DASHBOARD_MAX_BATCHES).iloc[::-1]
+    batches['batch'] = (
+        batches['client'].replace('', 'N/A') + ' '
+        + pd.to_datetime(batches['created_at'], unit='s').dt.strftime('%Y-%m-%d %H:%M')
+    )
+    batches['redemption_rate'] = batches['redeemed'] / batches['issued']
+    charts['per_batch'] = px.bar(
+        batches, x='batch', y='redemption_rate', hover_data=['issued', 'redeemed'],
+        title=f'Redemption rate per batch (last {DASHBOARD_MAX_BATCHES})',
+        labels={'batch': 'Batch', 'redemption_rate': 'Redemption rate'}
+    ).update_yaxes(tickformat='.0%').to_json()
+
+    labels = [label for _, label in REDEEM_LATENCY_BUCKETS] + [REDEEM_LATENCY_OVERFLOW]
+    latency = read_sql("SELECT bucket, count FROM redeem_latency").groupby('bucket')['count'].sum().to_dict()
+    charts['time_to_redeem'] = px.bar(
+        x=labels, y=[latency.get(index, 0) for index in range(len(labels))],
+        title='Time from issue to redemption', labels={'x': 'Time to redeem', 'y': 'Coupons'}
+    ).to_json()
+    return charts
+
+def dashboard_charts():
+    """
+    Dashboard figures, cached until the rollups change (counters.analytics_version)
+    or the hour rolls over (which moves the per-hour window).
+    """
+    version = 0
+    for path in all_dbs():
+        with get_db(path) as conn:
+            row = conn.execute("SELECT value FROM counters WHERE name = 'analytics_version'").fetchone()
+        version += row[0] if row else 0
+    key = (version, now_epoch() // 3600)
+    cached = _dashboard_cache.get('charts')
+    if cached and cached[0] == key:
+        return cached[1]
+    charts = build_dashboard_charts()
+    _dashboard_cache['charts'] = (key, charts)
+    return charts
+
+@app.route('/dashboard')
+def dashboard():
+    """Redemption analytics: per hour/day, per client, per batch, time-to-redeem."""
+    return render_template("dashboard.html", charts=dashboard_charts())
+
+@app.route('/api/dashboard')
+def api_dashboard():
+    """The dashboard's Plotly figures as JSON."""
+    charts = dashboard_charts()
+    return jsonify({name: json.loads(figure) for name, figure in charts.items()})
+
+def parse_day(value, end_of_day=False):
+    """
+    Parses a YYYY-MM-DD form value as local midnight, in epoch seconds.
+    With end_of_day, returns the following midnight (for exclusive upper bounds).
+    """
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+    if end_of_day:
+        day += timedelta(days=1)
+    return int(day.timestamp())
+
+def history_filters(args):
+    """
+    Reads the filters shared by /history, /history/export and bulk actions
+    from the query string: client, status (active/redeemed/expired, read
+    from the materialized status column), and a
+    since/until day range on date_field (created_at or redeemed_at).
+    Returns (filters with since/until as epoch bounds or None, the filter
+    values to carry over in links).
+    """
+    filters = {
+        'client': args.get('client', ''),
+        'status': args.get('status', ''),
+        'since': args.get('since', ''),
+        'until': args.get('until', ''),
+        'date_field': args.get('date_field', 'created_at'),
+    }
+    if filters['status'] not in HISTORY_STATUSES:
+        filters['status'] = ''
+    if filters['date_field'] not in HISTORY_DATE_FIELDS:
+        filters['date_field'] = 'created_at'
+
+    since = parse_day(filters['since'])
+    until = parse_day(filters['until'], end_of_day=True)
+    if since is None:
+        filters['since'] = ''
+    if until is None:
+        filters['until'] = ''
+
+    link_args = {key: value for key, value in filters.items() if value}
+    if 'since' not in link_args and 'until' not in link_args:
+        link_args.pop('date_field', None)
+    return dict(filters, since=since, until=until), link_args
+
+def filter_sql(filters):
+    """WHERE clauses and params for filters from history_filters."""
+    where = []
+    params = []
+    if filters['client']:
+        # Evaluated once, then an equality on the client_id index
+        where.append("client_id = (SELECT id FROM clients WHERE name = ?)")
+        params.append(filters['client'])
+    if filters['status']:
+        where.append("status=?")
+        params.append(filters['status'])
+    if filters['since'] is not None:
+        where.append(f"{filters['date_field']} >= ?")
+        params.append(filters['since'])
+    if filters['until'] is not None:
+        where.append(f"{filters['date_field']} < ?")
+        params.append(filters['until'])
+    return where, params
 
 @app.route('/history')
+@conditional_page()
 def history():
     """
-    Shows a list of coupons with redemption status. 
-    Optional filter by client: /history?client=XYZ
+    Shows a page of coupons with redemption status.
+    Optional filters (see history_filters): /history?client=XYZ&status=redeemed
+    Sorting: ?sort=id|created_at|expires_at|code&order=asc|desc
+    Paging is by keyset: ?after=<cursor> for the next page, ?before=<cursor>
+    for the previous one, so every page costs the same however deep it is.
+    """
+    filters, filter_args = history_filters(request.args)
+    sort = request.args.get('sort', 'id')
+    if sort not in HISTORY_SORT_COLUMNS:
+        sort = 'id'
+    order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+    try:
+        per_page = min(max(int(request.args.get('per_page', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        per_page = HISTORY_PAGE_SIZE
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if not after else None
+
+    # Going backwards means reading in the opposite order and flipping the page
+    backwards = before is not None
+    descending = (order == 'desc') != backwards
+
+    # The rollup tables only know totals per client
+    total = store.count(filters['client']) if set(filter_args) <= {'client'} else None
+
+    base_args = dict(filter_args, sort=sort, order=order)
+    if per_page != HISTORY_PAGE_SIZE:
+        base_args['per_page'] = per_page
+    # Filled in by iter_coupons once the last row has gone out; the template
+    # only reads it below the table
+    pager = {'next_url': None, 'prev_url': None}
+
+    def iter_coupons():
+        """Yields the page's rows straight from the store while the template renders them."""
+        source = store.list(filters, sort, descending, after or before, per_page + 1)
+        try:
+            if backwards:
+                # At most per_page + 1 rows, read in reverse and flipped
+                rows = list(itertools.islice(source, per_page + 1))
+                has_more = len(rows) > per_page
+                rows = rows[:per_page][::-1]
+            else:
+                rows = source
+                has_more = False
+            first = last = None
+            for count, row in enumerate(rows):
+                if count == per_page:
+                    has_more = True
+                    break
+                sort_value = row['code_num'] if sort == 'code' else row[sort]
+                last = dict(
+                    row,
+                    created_at=format_epoch(row['created_at']),
+                    expires_at=format_epoch(row['expires_at']),
+                    cursor=encode_cursor([sort_value, row['id']]),
+                )
+                first = first or last
+                yield last
+        finally:
+            source.close()
+        if last and (has_more or backwards):
+            pager['next_url'] = url_for('history', after=last['cursor'], **base_args)
+        if first and (after or (backwards and has_more)):
+            pager['prev_url'] = url_for('history', before=first['cursor'], **base_args)
+
+    sort_urls = {}
+    for column in HISTORY_SORT_COLUMNS:
+        column_order = 'asc' if column == sort and order == 'desc' else 'desc'
+        sort_urls[column] = url_for('history', sort=column, order=column_order, **filter_args)
+
+    return stream_template(
+        "history.html", coupons=iter_coupons(), clients=store.clients(), pager=pager, total=total, sort=sort, order=order,
+        sort_urls=sort_urls, first_url=url_for('history', **base_args), filter_args=filter_args,
+        export_urls={fmt: url_for('export_history', format=fmt, **filter_args) for fmt in ('csv', 'ndjson')}
+    )
+
+@app.route('/history/export')
+def export_history():
+    """
+    Streams every coupon matching the /history filters as CSV or NDJSON:
+    /history/export?format=csv|ndjson&client=XYZ&status=redeemed&since=...
+    Rows are read from the cursor and written in small chunks, so memory
+    stays flat however many rows match.
     """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        abort(400)
+    where, params = filter_sql(history_filters(request.args)[0])
+    sql = """
+        SELECT id, code, email, client, domain, status,
+               created_at, expires_at, redeemed, redeemed_at
+        FROM coupons
+    """
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+
     client_name = request.args.get('client', '')
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        if client_name:
-            c.execute("SELECT code, email, redeemed, domain, client FROM coupons WHERE client=?", (client_name,))
-        else:
-            c.execute("SELECT code, email, redeemed, domain, client FROM coupons")
-        rows = c.fetchall()
+    paths = [client_db(client_name)] if client_name else all_dbs()
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(EXPORT_FIELDS)
+        # Shards hold consecutive id ranges, so reading them in turn keeps id order
+        for path in paths:
+            c = get_db(path).cursor()
+            try:
+                c.execute(sql, params)
+                while True:
+                    rows = c.fetchmany(EXPORT_CHUNK_ROWS)
+                    if not rows:
+                        break
+                    for row in rows:
+                        record = dict(zip(EXPORT_FIELDS, row))
+                        for field in TIMESTAMP_COLUMNS:
+                            record[field] = format_epoch(record[field])
+                        if fmt == 'csv':
+                            writer.writerow(record[field] for field in EXPORT_FIELDS)
+                        else:
+                            buffer.write(json.dumps(record) + "\n")
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            finally:
+                c.close()
+        yield buffer.getvalue()
+
+    filename = f"coupons-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
+def has_search_index(conn):
+    """True if the FTS5 search table exists (see add_coupon_search_index)."""
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='coupons_fts'")
+    return c.fetchone() is not None
+
+@app.route('/search')
+@conditional_page()
+def search():
+    """
+    Finds coupons whose code, email or client contains the query
+    (case-insensitive), newest first: /search?q=john@
+    Paged by id: ?after=<id of the last row shown>.
+    """
+    query = request.args.get('q', '').strip()
+    try:
+        after = int(request.args.get('after', ''))
+    except ValueError:
+        after = None
     coupons = []
-    for code, email, redeemed, domain, client in rows:
-        coupons.append({
-            'code': code,
-            'email': email,
-            'redeemed': redeemed,
-            'domain': domain,
-            'client': client
-        })
-    return render_template("history.html", coupons=coupons)
+    next_url = None
+    error_message = None
+
+    if query and len(query) < SEARCH_MIN_LENGTH:
+        error_message = f"Please type at least {SEARCH_MIN_LENGTH} characters."
+    elif query:
+        def search_db(path):
+            with get_db(path) as conn:
+                c = conn.cursor()
+                params = []
+                if has_search_index(conn):
+                    # Quoted as one phrase, so the trigram tokenizer does a substring match
+                    sql = '''
+                        SELECT c.id, c.code, c.email, c.redeemed, c.domain, c.client, c.created_at, c.expires_at
+                        FROM coupons_fts f JOIN coupons c ON c.id = f.rowid
+                        WHERE coupons_fts MATCH ?
+                    '''
+                    params.append('"' + query.replace('"', '""') + '"')
+                    id_column = 'f.rowid'
+                else:
+                    sql = '''
+                        SELECT id, code, email, redeemed, domain, client, created_at, expires_at
+                        FROM coupons
+                        WHERE (code LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\' OR client LIKE ? ESCAPE '\\')
+                    '''
+                    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                    params.extend([pattern] * 3)
+                    id_column = 'id'
+                if after is not None:
+                    sql += f" AND {id_column} < ?"
+                    params.append(after)
+                sql += f" ORDER BY {id_column} DESC LIMIT ?"
+                params.append(SEARCH_PAGE_SIZE + 1)
+                c.execute(sql, params)
+                return c.fetchall()
+
+        # Newest first across every shard (ids are unique across them)
+        rows = list(itertools.islice(
+            heapq.merge(*fan_out(search_db), key=lambda row: row[0], reverse=True),
+            SEARCH_PAGE_SIZE + 1
+        ))
+
+        for id_, code, email, redeemed, domain, client, created_at, expires_at in rows[:SEARCH_PAGE_SIZE]:
+            coupons.append({
+                'id': id_,
+                'code': code,
+                'email': email,
+                'redeemed': redeemed,
+                'domain': domain,
+                'client': client,
+                'created_at': format_epoch(created_at),
+                'expires_at': format_epoch(expires_at),
+            })
+        if len(rows) > SEARCH_PAGE_SIZE:
+            next_url = url_for('search', q=query, after=coupons[-1]['id'])
+
+    return render_template(
+        "search.html", query=query, coupons=coupons, next_url=next_url,
+        first_url=url_for('search', q=query) if after is not None else None,
+        error_message=error_message
+    )
+
+def refresh_code_states(c, codes):
+    """
+    Re-reads codes after a bulk change and brings the state cache and the
+    shared status map in line with the database.
+    """
+    codes = list(codes)
+    state_cache.invalidate(*codes)
+    found = set()
+    statuses = []
+    where, params = code_condition(codes)
+    c.execute(
+        f"SELECT code, redeemed, ({EXPIRES_AT_EPOCH_SQL}) < ? FROM coupons WHERE {where}",
+        [now_epoch()] + params
+    )
+    for code, redeemed, expired in c.fetchall():
+        found.add(code)
+        statuses.append((code, STATUS_REDEEMED if redeemed else STATUS_EXPIRED if expired else STATUS_ACTIVE))
+    statuses.extend((code, STATUS_ABSENT) for code in codes if code not in found)
+    status_map.set_many(statuses)
+
+def apply_bulk_action(c, action, ids, extend_days=0):
+    """
+    Applies one bulk action to a chunk of coupon ids, inside the caller's
+    transaction. Returns the codes of those coupons; the caller refreshes
+    their states (and cleans up QR files) once the transaction has committed.
+    """
+    placeholders = ",".join("?" * len(ids))
+    c.execute(f"SELECT code FROM coupons WHERE id IN ({placeholders})", ids)
+    codes = [row[0] for row in c.fetchall()]
+    if action == 'delete':
+        c.execute(f"DELETE FROM coupons WHERE id IN ({placeholders})", ids)
+    elif action == 'extend':
+        # Only coupons that can still be used; redeemed ones keep their dates
+        c.execute(
+            f"UPDATE coupons SET expires_at = expires_at + ? WHERE redeemed=0 AND id IN ({placeholders})",
+            [extend_days * 24 * 3600] + ids
+        )
+    elif action == 'redeem':
+        c.execute(
+            f"UPDATE coupons SET redeemed=1, redeemed_at=? WHERE redeemed=0 AND id IN ({placeholders})",
+            [now_epoch()] + ids
+        )
+    if c.rowcount:
+        bump_data_version(c)
+    return codes
+
+def redirect_back(default_endpoint='history'):
+    """Redirects to the page the form was posted from (kept filters and page), if it's one of ours."""
+    target = request.form.get('next', '')
+    if target.startswith(SAFE_REDIRECT_PREFIXES) and not target.startswith('//'):
+        return redirect(target)
+    return redirect(url_for(default_endpoint))
 
 @app.route('/delete_coupon', methods=['POST'])
 def delete_coupon():
-    """Deletes a coupon by its code, then redirects back to history page."""
-    code = request.form.get('code', '')
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM coupons WHERE code=?", (code,))
-        conn.commit()
-    return redirect(url_for('history'))
+    """Deletes a coupon by its code, then redirects back to the page it was deleted from."""
+    store.delete([request.form.get('code', '')])
+    return redirect_back()
+
+@app.route('/history/bulk', methods=['POST'])
+def bulk_action():
+    """
+    Deletes, extends (by extend_days) or marks redeemed many coupons at once:
+      - scope=selected: the codes ticked on the page
+      - scope=filter:   every coupon matching the history filters in the form
+    Work is done in chunks of BULK_CHUNK_SIZE, one write-queue op each, so
+    other requests' writes get committed in between.
+    """
+    action = request.form.get('action', '')
+    if action not in BULK_ACTIONS:
+        abort(400)
+    try:
+        extend_days = int(request.form.get('extend_days', '0'))
+    except ValueError:
+        extend_days = 0
+    if action == 'extend' and extend_days <= 0:
+        abort(400)
+
+    def apply(c, path, ids):
+        codes = writer_for(path).run(functools.partial(apply_bulk_action, action=action, ids=ids, extend_days=extend_days))
+        # Only after the commit: if it fails, the map and QR files still match the rows
+        refresh_code_states(c, codes)
+        if action == 'delete':
+            schedule_qr_cleanup(codes)
+
+    if request.form.get('scope') == 'filter':
+        filters, _ = history_filters(request.form)
+        where, params = filter_sql(filters)
+        client_name = filters['client']
+        for path in [client_db(client_name)] if client_name else all_dbs():
+            with get_db(path) as conn:
+                c = conn.cursor()
+                last_id = 0
+                while True:
+                    sql = "SELECT id FROM coupons WHERE " + " AND ".join(where + ["id > ?"])
+                    c.execute(sql + " ORDER BY id LIMIT ?", params + [last_id, BULK_CHUNK_SIZE])
+                    ids = [row[0] for row in c.fetchall()]
+                    if not ids:
+                        break
+                    apply(c, path, ids)
+                    last_id = ids[-1]
+    else:
+        by_db = {}
+        for code in request.form.getlist('codes'):
+            by_db.setdefault(code_db(code), []).append(code)
+        for path, codes in by_db.items():
+            with get_db(path) as conn:
+                c = conn.cursor()
+                for start in range(0, len(codes), BULK_CHUNK_SIZE):
+                    where, params = code_condition(codes[start:start + BULK_CHUNK_SIZE])
+                    c.execute(f"SELECT id FROM coupons WHERE {where}", params)
+                    ids = [row[0] for row in c.fetchall()]
+                    if ids:
+                        apply(c, path, ids)
+    return redirect_back()
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit-rate and size of the coupon state cache (for this worker only)."""
+    return jsonify(state_cache.stats())
+
+@app.route('/store_stats')
+def store_stats():
+    """Calls and timings per CouponStore operation (for this worker only)."""
+    return jsonify(store.metrics())
+
+def archive_partition(terminal_at):
+    """Archive file name for a coupon that was redeemed/expired at terminal_at."""
+    return f"coupons-{datetime.fromtimestamp(terminal_at or 0, timezone.utc).strftime('%Y-%m')}.ndjson.gz"
+
+def archive_coupons(older_than_days=ARCHIVE_AFTER_DAYS):
+    """
+    Moves coupons redeemed or expired more than older_than_days ago out of
+    the coupons table, in chunks:
+      1. append the full rows to the month's gzip NDJSON file and fsync it,
+      2. then, in one transaction, write tombstones and delete the rows.
+    A crash between the two steps can only duplicate lines in the archive,
+    never lose a coupon. Stats and analytics keep counting archived rows.
+    Returns the number of coupons archived.
+    """
+    cutoff = now_epoch() - older_than_days * 24 * 3600
+    columns = ['id', 'email', 'code', 'created_at', 'expires_at', 'redeemed', 'domain', 'client', 'redeemed_at']
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    archived = 0
+    for path in all_dbs():
+        with get_db(path) as conn:
+            last_id = 0
+            c = conn.cursor()
+            while True:
+                c.execute(
+                    f"""
+                    SELECT {', '.join(columns)} FROM coupons
+                    WHERE id > ? AND (
+                        (redeemed = 1 AND COALESCE(redeemed_at, created_at) < ?)
+                        OR (redeemed = 0 AND expires_at < ?)
+                    )
+                    ORDER BY id LIMIT ?
+                    """,
+                    (last_id, cutoff, cutoff, ARCHIVE_CHUNK_SIZE)
+                )
+                rows = [dict(zip(columns, row)) for row in c.fetchall()]
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+
+                partitions = {}
+                for row in rows:
+                    terminal_at = row['redeemed_at'] or row['created_at'] if row['redeemed'] else row['expires_at']
+                    partitions.setdefault(archive_partition(terminal_at), []).append(row)
+                for partition, partition_rows in partitions.items():
+                    # Appending makes a multi-member gzip file, which gzip.open reads as one stream
+                    with gzip.open(os.path.join(ARCHIVE_FOLDER, partition), 'at', encoding='utf-8') as f:
+                        for row in partition_rows:
+                            f.write(json.dumps(row) + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                now = now_epoch()
+                tombstones = [
+                    (row['code'], STATUS_REDEEMED if row['redeemed'] else STATUS_EXPIRED, now, partition)
+                    for partition, partition_rows in partitions.items() for row in partition_rows
+                ]
+                per_client = {}
+                for row in rows:
+                    client = row['client'] or ''
+                    per_client[client] = per_client.get(client, 0) + 1
+                placeholders = ",".join("?" * len(rows))
+
+                c.execute("BEGIN IMMEDIATE")
+                c.execute("INSERT OR IGNORE INTO maintenance_flags (name) VALUES ('archiving')")
+                c.executemany("INSERT OR REPLACE INTO archived_codes (code, status, archived_at, partition) VALUES (?, ?, ?, ?)", tombstones)
+                c.execute(f"DELETE FROM coupons WHERE id IN ({placeholders})", [row['id'] for row in rows])
+                c.executemany("UPDATE client_stats SET archived = archived + ? WHERE client = ?",
+                              [(count, client) for client, count in per_client.items()])
+                c.execute("DELETE FROM maintenance_flags WHERE name = 'archiving'")
+                bump_data_version(c)
+                conn.commit()
+
+                state_cache.invalidate(*(row['code'] for row in rows))
+                status_map.set_many((code, status) for code, status, _, _ in tombstones)
+                archived += len(rows)
+    return archived
+
+class BackupRestarted(Exception):
+    """Raised from the backup progress callback to give up on a paged copy."""
+
+def rotate_backups(keep=BACKUP_KEEP, stem='coupons'):
+    """
+    Deletes all but the newest keep snapshots of one database (by file
+    stem) in BACKUP_FOLDER. Returns the names removed.
+    """
+    names = sorted(
+        name for name in os.listdir(BACKUP_FOLDER)
+        if re.fullmatch(rf"{re.escape(stem)}-\d{{8}}-\d{{6}}-\d{{6}}\.db(\.gz)?", name)
+    )
+    removed = names[:-keep] if keep > 0 else names
+    for name in removed:
+        os.remove(os.path.join(BACKUP_FOLDER, name))
+    return removed
+
+def backup_database(compress=False, keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE, path=None):
+    """
+    Writes a consistent snapshot of a live database (DATABASE by default,
+    or one shard's file) to BACKUP_FOLDER
+    through sqlite3.Connection.backup, without stopping writes:
+    pages at a time with a pause between steps (see BACKUP_MAX_RESTARTS for
+    what happens when writes keep restarting it). The copy is written under
+    a .partial name and only renamed once complete, then optionally gzipped,
+    and old snapshots are rotated out.
+    Returns a summary: path, size, pages, seconds, pages_per_second, steps,
+    restarts, and whether it had to finish in one step.
+    """
+    os.makedirs(BACKUP_FOLDER, exist_ok=True)
+    source_path = path or DATABASE
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    path = os.path.join(BACKUP_FOLDER, f"{stem}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.db")
+    partial = path + '.partial'
+    progress = {'steps': 0, 'restarts': 0, 'pages': 0, 'remaining': None}
+
+    def on_step(status, remaining, total):
+        progress['steps'] += 1
+        progress['pages'] = total
+        # No progress means another connection's write restarted the copy
+        if progress['remaining'] is not None and remaining >= progress['remaining']:
+            progress['restarts'] += 1
+            if progress['restarts'] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        progress['remaining'] = remaining
+        if remaining:
+            time.sleep(pause)
+
+    start = time.perf_counter()
+    one_step = False
+    source = connect_db(source_path)
+    try:
+        dest = sqlite3.connect(partial)
+        try:
+            try:
+                source.backup(dest, pages=pages, progress=on_step)
+            except BackupRestarted:
+                one_step = True
+                source.backup(dest, pages=-1, progress=on_step)
+        finally:
+            dest.close()
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        source.close()
+    os.replace(partial, path)
+    seconds = time.perf_counter() - start
+
+    if compress:
+        with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        path += '.gz'
+    rotate_backups(keep, stem)
+    return {
+        'path': path,
+        'size': os.path.getsize(path),
+        'pages': progress['pages'],
+        'seconds': round(seconds, 3),
+        'pages_per_second': round(progress['pages'] / seconds) if seconds else 0,
+        'steps': progress['steps'],
+        'restarts': progress['restarts'],
+        'one_step': one_step,
+    }
+
+_backup_lock = threading.Lock()
+_backup_state = {'running': False, 'last': None, 'error': None}
+
+def _run_backup(compress):
+    try:
+        result = [backup_database(compress=compress, path=path) for path in all_dbs()]
+        with _backup_lock:
+            _backup_state.update(last=result, error=None)
+    except Exception as e:
+        app.logger.warning("Backup failed: %s", e)
+        with _backup_lock:
+            _backup_state['error'] = str(e)
+    finally:
+        with _backup_lock:
+            _backup_state['running'] = False
+
+@app.route('/admin/backup', methods=['GET', 'POST'])
+def admin_backup():
+    """
+    POST starts an online snapshot (of every shard, when sharded) in a background thread (?compress=1 to
+    gzip it) and answers 202, or 409 if one is already running.
+    GET reports whether one is running and how the last one went.
+    """
+    if request.method == 'POST':
+        with _backup_lock:
+            if _backup_state['running']:
+                return jsonify(_backup_state), 409
+            _backup_state['running'] = True
+        compress = request.args.get('compress', '') in ('1', 'true', 'yes')
+        threading.Thread(target=_run_backup, args=(compress,), name='backup', daemon=True).start()
+        with _backup_lock:
+            return jsonify(_backup_state), 202
+    with _backup_lock:
+        return jsonify(_backup_state)
+
+def percentile(values, p):
+    """Value at percentile p (0-1) of an already sorted list, or 0 if it's empty."""
+    if not values:
+        return 0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+@app.cli.command('archive')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Archive coupons redeemed or expired more than this many days ago.")
+def archive_command(days):
+    """Moves old redeemed/expired coupons into the gzip NDJSON archive."""
+    count = archive_coupons(days)
+    click.echo(f"Archived {count} coupons into {ARCHIVE_FOLDER}")
+
+@app.cli.command('sweep-expired')
+def sweep_expired_command():
+    """Marks every active coupon past its expiry as expired, now."""
+    click.echo(f"Expired {sweep_expired()} coupons")
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Applies pending schema migrations."""
+    applied = startup()
+    for name in applied:
+        click.echo(f"Applied {name}")
+    click.echo(f"Schema is at version {len(MIGRATIONS)}")
+
+@app.cli.command('backup')
+@click.option('--compress', is_flag=True, help="Gzip the snapshot.")
+@click.option('--keep', default=BACKUP_KEEP, show_default=True, help="Snapshots to keep; older ones are deleted.")
+@click.option('--pages', default=BACKUP_PAGES_PER_STEP, show_default=True, help="Pages copied per step.")
+@click.option('--pause', default=BACKUP_STEP_PAUSE, show_default=True, help="Seconds to pause between steps.")
+@click.option('--probe/--no-probe', default=True, show_default=True,
+              help="Time validation lookups before and during the backup.")
+def backup_command(compress, keep, pages, pause, probe):
+    """
+    Takes a consistent snapshot of the live database into BACKUP_FOLDER,
+    and reports its speed and what it did to validation lookup latency.
+    """
+    startup()
+    codes = []
+    for path in all_dbs():
+        with get_db(path) as conn:
+            codes.extend(row[0] for row in conn.execute("SELECT code FROM coupons LIMIT 1000"))
+    stop = threading.Event()
+    latencies = []
+
+    def lookup():
+        """The lookup store.redeem runs, on random existing codes, until stopped."""
+        while not stop.is_set():
+            code = random.choice(codes)
+            where, params = code_condition([code])
+            start = time.perf_counter()
+            with get_db(code_db(code)) as conn:
+                conn.execute(
+                    f"SELECT id, redeemed, ({EXPIRES_AT_EPOCH_SQL}) < ? FROM coupons WHERE {where}",
+                    [now_epoch()] + params
+                ).fetchone()
+            latencies.append(time.perf_counter() - start)
+            # Leave the GIL to the backup thread now and then, like real traffic would
+            time.sleep(0.0005)
+
+    def probed(fn):
+        """Runs fn() with lookup() in the background; returns (fn's result, sorted latencies)."""
+        stop.clear()
+        latencies.clear()
+        thread = threading.Thread(target=lookup)
+        thread.start()
+        try:
+            result = fn()
+        finally:
+            stop.set()
+            thread.join()
+        return result, sorted(latencies)
+
+    probe = probe and bool(codes)
+    def backup_all():
+        return [backup_database(compress, keep, pages, pause, path) for path in all_dbs()]
+
+    if probe:
+        _, baseline = probed(lambda: time.sleep(1))
+        results, during = probed(backup_all)
+    else:
+        results = backup_all()
+
+    for result in results:
+        click.echo(
+            f"Snapshot {result['path']} ({result['size'] / 1024 / 1024:.1f} MB): {result['pages']} pages "
+            f"in {result['seconds']:.2f} s, {result['pages_per_second']} pages/s, {result['steps']} steps, "
+            f"{result['restarts']} restarts" + (", finished in one step" if result['one_step'] else "")
+        )
+    if probe:
+        for label, values in (('before', baseline), ('during', during)):
+            click.echo(
+                f"validation lookups {label}: {len(values)}  p50 {percentile(values, 0.5) * 1000:.2f} ms  "
+                f"p99 {percentile(values, 0.99) * 1000:.2f} ms  max {percentile(values, 1) * 1000:.2f} ms"
+            )
+
+@app.cli.command('vendor-assets')
+def vendor_assets_command():
+    """Downloads the pinned third-party scripts in VENDOR_ASSETS into Static/ (commit the result)."""
+    for filename, source_url in VENDOR_ASSETS.items():
+        path = os.path.join(app.static_folder, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(source_url, timeout=30) as response:
+            data = response.read()
+        with open(path, 'wb') as f:
+            f.write(data)
+        click.echo(f"{filename}: {len(data)} bytes from {source_url}")
+
+@app.cli.command('rebuild-status-map')
+def rebuild_status_map_command():
+    """Rebuilds the shared code status map from the database."""
+    count = status_map.rebuild(get_db(path) for path in all_dbs())
+    click.echo(f"Status map rebuilt: {count} codes written to {status_map.path}")
 
 if __name__ == '__main__':
-    init_db()
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,32 @@
+"""
+Shared setup for the benchmark scripts in this folder. They import the app
+and point it at throwaway files through create_app, so they never touch the
+real database, status map or QR folder.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as coupons_app
+
+
+def use_throwaway_db(folder, name='bench', **settings):
+    """
+    Configures the app on a fresh, migrated database called name in folder
+    (unsharded, with its own status map and QR folder); settings override
+    any other SETTINGS. Returns the app module.
+    """
+    config = {
+        'DATABASE': os.path.join(folder, f"{name}.db"),
+        'STATUS_MAP_FILE': os.path.join(folder, f"{name}.map"),
+        'STATIC_QR_FOLDER': os.path.join(folder, 'qr'),
+        'GENERATED_CSV_FOLDER': os.path.join(folder, 'generated_csv'),
+        'ARCHIVE_FOLDER': os.path.join(folder, 'archive'),
+        'BACKUP_FOLDER': os.path.join(folder, 'backups'),
+        'SHARD_FOLDER': os.path.join(folder, 'shards'),
+        'SHARD_COUNT': 0,
+    }
+    config.update(settings)
+    coupons_app.create_app(config)
+    return coupons_app
@@ -0,0 +1,70 @@
+"""
+Compares database size and lookup latency of codes stored as TEXT UNIQUE
+against code_num INTEGER UNIQUE (with code as a generated column), on
+throwaway databases holding the same random codes.
+
+    python bench/codes.py --rows 1000000 --lookups 100000
+"""
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import click
+
+from _common import coupons_app as app
+
+
+@click.command()
+@click.option('--rows', default=1000000, show_default=True, help="Coupons in each test table.")
+@click.option('--lookups', default=100000, show_default=True, help="Random code lookups to time.")
+def main(rows, lookups):
+    space = len(app.CODE_ALPHABET) ** app.CODE_LENGTH
+    if rows > space:
+        raise click.BadParameter(f"the code space only has {space} codes", param_hint='--rows')
+    nums = random.sample(range(space), rows)
+    codes = [app.CODE_PREFIX + ''.join(
+        app.CODE_ALPHABET[num // len(app.CODE_ALPHABET) ** power % len(app.CODE_ALPHABET)]
+        for power in reversed(range(app.CODE_LENGTH))
+    ) for num in nums]
+    probes = random.choices(codes, k=lookups)
+    layouts = [
+        ('TEXT UNIQUE', "code TEXT UNIQUE",
+         "INSERT INTO coupons (code, created_at) VALUES (?, 0)", lambda code: code,
+         lambda code: ("code = ?", [code])),
+        ('code_num INTEGER', f"code_num INTEGER, code_text TEXT, code TEXT GENERATED ALWAYS AS "
+                             f"(COALESCE(code_text, {app._code_sql('code_num')})) VIRTUAL",
+         "INSERT INTO coupons (code_num, created_at) VALUES (?, 0)", app.code_index,
+         lambda code: app.code_condition([code])),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, columns, insert, stored, condition in layouts:
+            path = os.path.join(tmp, 'codes.db')
+            conn = sqlite3.connect(path)
+            conn.execute(f"CREATE TABLE coupons (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns}, created_at INTEGER)")
+            if 'code_num' in columns:
+                conn.execute("CREATE UNIQUE INDEX idx_coupons_code_num ON coupons (code_num)")
+                conn.execute("CREATE UNIQUE INDEX idx_coupons_code_text ON coupons (code_text) WHERE code_text IS NOT NULL")
+            conn.executemany(insert, ((stored(code),) for code in codes))
+            conn.commit()
+            conn.execute("VACUUM")
+            size = os.path.getsize(path)
+
+            start = time.perf_counter()
+            queries = [condition(code) for code in probes]
+            encoded = time.perf_counter()
+            for where, params in queries:
+                # What validation reads: the row, not the code it already has
+                conn.execute(f"SELECT id, created_at FROM coupons WHERE {where}", params).fetchone()
+            done = time.perf_counter()
+            conn.close()
+            os.remove(path)
+            click.echo(
+                f"{label:>16}: {size / 1024 / 1024:7.1f} MB  "
+                f"encode {(encoded - start) / lookups * 1e6:5.2f} us + query {(done - encoded) / lookups * 1e6:5.2f} us per lookup"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Times code lookups (the query validate_coupon runs) while another thread
+keeps generating batches, on a throwaway database: once with a plain
+connection per use in rollback-journal mode, once pooled in WAL.
+
+    python bench/concurrency.py --seconds 5 --readers 4
+"""
+import itertools
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+import click
+
+from _common import use_throwaway_db
+
+
+@click.command()
+@click.option('--seconds', default=5.0, show_default=True, help="Length of each run.")
+@click.option('--readers', default=4, show_default=True, help="Threads looking up codes.")
+@click.option('--batch', default=200, show_default=True, help="Coupons per generated batch.")
+def main(seconds, readers, batch):
+    with tempfile.TemporaryDirectory() as tmp:
+        for pooled in (False, True):
+            app = use_throwaway_db(tmp, f"bench-{pooled}", POOL_CONNECTIONS=pooled)
+            # Outside the VIP code space, so generated batches can't collide with them
+            codes = [f"BEN{i:06d}" for i in range(10000)]
+            now = app.now_epoch()
+            with app.get_db() as conn:
+                conn.executemany(
+                    "INSERT INTO coupons (code_text, created_at, expires_at, domain) VALUES (?, ?, ?, ?)",
+                    [(code, now, now + 86400, app.DEFAULT_DOMAIN) for code in codes]
+                )
+
+            stop = threading.Event()
+            latencies = []
+            errors = []
+            batches = []
+
+            def lookup():
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        with app.get_db() as conn:
+                            conn.execute(
+                                f"SELECT redeemed, ({app.EXPIRES_AT_EPOCH_SQL}) < ? FROM coupons WHERE code_text=?",
+                                (now, random.choice(codes))
+                            ).fetchone()
+                    except sqlite3.OperationalError:
+                        errors.append(1)
+                        continue
+                    latencies.append(time.perf_counter() - start)
+
+            def generate():
+                while not stop.is_set():
+                    for _ in app.create_coupons(itertools.repeat(None, batch), 'bench', os.path.join(tmp, 'bench.csv')):
+                        pass
+                    batches.append(1)
+
+            threads = [threading.Thread(target=generate)] + [threading.Thread(target=lookup) for _ in range(readers)]
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            latencies.sort()
+            p50, p99, slowest = (app.percentile(latencies, p) * 1000 for p in (0.5, 0.99, 1))
+            label = 'pooled, WAL' if pooled else 'per-use, rollback journal'
+            click.echo(
+                f"{label:>26}: {len(latencies) / seconds:8.0f} lookups/s  "
+                f"p50 {p50:6.2f} ms  p99 {p99:7.2f} ms  "
+                f"max {slowest:7.2f} ms  locked {len(errors)}  batches {len(batches)}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Runs the same workload through MemoryCouponStore and SQLiteCouponStore
+(on a throwaway database) and prints each operation's timings.
+
+    python bench/store.py --coupons 20000 --redemptions 5000 --pages 50
+"""
+import random
+import tempfile
+
+import click
+
+from _common import use_throwaway_db
+
+
+@click.command()
+@click.option('--coupons', default=20000, show_default=True, help="Coupons generated per backend.")
+@click.option('--redemptions', default=5000, show_default=True, help="Random redemptions (repeats included).")
+@click.option('--pages', default=50, show_default=True, help="History pages walked by keyset.")
+def main(coupons, redemptions, pages):
+    clients = ['alpha', 'bravo', 'charlie', '']
+    with tempfile.TemporaryDirectory() as tmp:
+        app = use_throwaway_db(tmp)
+        filters = app.history_filters({})[0]
+        for backend in (app.MemoryCouponStore(), app.SQLiteCouponStore()):
+            now = app.now_epoch()
+            codes = []
+            for start in range(0, coupons, app.SQL_IN_CHUNK):
+                client = clients[start // app.SQL_IN_CHUNK % len(clients)]
+                chunk = backend.allocate(client, min(app.SQL_IN_CHUNK, coupons - start))
+                backend.insert_bulk([
+                    {'email': None, 'code': code, 'client': client, 'domain': app.DEFAULT_DOMAIN,
+                     'created_at': now, 'expires_at': now + 86400}
+                    for code in chunk
+                ])
+                codes.extend(chunk)
+            for code in random.choices(codes, k=redemptions):
+                backend.redeem(code)
+            for client in clients:
+                cursor = None
+                for _ in range(pages):
+                    rows = list(backend.list(dict(filters, client=client), 'created_at', True, cursor, app.HISTORY_PAGE_SIZE))
+                    if not rows:
+                        break
+                    cursor = [rows[-1]['created_at'], rows[-1]['id']]
+                backend.count(client)
+            backend.stats()
+            backend.delete(random.sample(codes, min(1000, len(codes))))
+
+            click.echo(type(backend).__name__)
+            for name, metric in backend.metrics().items():
+                click.echo(
+                    f"  {name:>12}: {metric['calls']:6d} calls  avg {metric['avg_ms']:9.4f} ms  "
+                    f"max {metric['max_ms']:9.3f} ms  total {metric['total_ms']:10.1f} ms"
+                )
+        # QR cleanup of the deleted coupons must finish before tmp goes away
+        app._qr_cleanup_queue.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+// Service worker for the scanner pages (rendered by the /sw.js route).
+// Hashed assets are cache-first: their URL changes whenever their content does.
+// Scanner pages are network-first with a short timeout, falling back to the
+// cached shell when the venue's uplink is slow or down.
+const CACHE_NAME = 'scanner-{{ cache_version }}';
+const PRECACHE_URLS = {{ precache|tojson }};
+const NETWORK_TIMEOUT_MS = 3000;
+
+self.addEventListener('install', (event) => {
+  event.waitUntil(
+    caches.open(CACHE_NAME).then((cache) =>
+      // One failed URL shouldn't stop the rest from being cached
+      Promise.all(PRECACHE_URLS.map((url) =>
+        cache.add(url).catch((err) => console.warn('Precache failed for', url, err))
+      ))
+    ).then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil(
+    caches.keys().then((names) => Promise.all(
+      names
+        .filter((name) => name.startsWith('scanner-') && name !== CACHE_NAME)
+        .map((name) => caches.delete(name))
+    )).then(() => self.clients.claim())
+  );
+});
+
+function networkFirst(request) {
+  return caches.open(CACHE_NAME).then((cache) => {
+    const network = fetch(request).then((response) => {
+      if (response.ok) {
+        cache.put(request, response.clone());
+      }
+      return response;
+    });
+    const timeout = new Promise((resolve) => {
+      setTimeout(() => cache.match(request).then((cached) => cached && resolve(cached)), NETWORK_TIMEOUT_MS);
+    });
+    return Promise.race([
+      network.catch(() => cache.match(request).then((cached) => cached || Promise.reject(new Error('offline')))),
+      timeout
+    ]);
+  });
+}
+
+function cacheFirst(request) {
+  return caches.match(request).then((cached) => cached || fetch(request).then((response) => {
+    if (response.ok) {
+      const copy = response.clone();
+      caches.open(CACHE_NAME).then((cache) => cache.put(request, copy));
+    }
+    return response;
+  }));
+}
+
+self.addEventListener('fetch', (event) => {
+  const request = event.request;
+  // Redemptions must always reach the server
+  if (request.method !== 'GET') {
+    return;
+  }
+  const url = new URL(request.url);
+  if (url.origin === self.location.origin && url.pathname.startsWith('/assets/')) {
+    event.respondWith(cacheFirst(request));
+  } else if (PRECACHE_URLS.includes(url.pathname) || PRECACHE_URLS.includes(request.url)) {
+    event.respondWith(request.mode === 'navigate' ? networkFirst(request) : cacheFirst(request));
+  }
+});
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as coupons_app
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    """Settings pointing every file the app writes into tmp_path."""
+    return {
+        'DATABASE': str(tmp_path / 'coupons.db'),
+        'STATUS_MAP_FILE': str(tmp_path / 'code_status.map'),
+        'STATIC_QR_FOLDER': str(tmp_path / 'qr'),
+        'GENERATED_CSV_FOLDER': str(tmp_path / 'generated_csv'),
+        'ARCHIVE_FOLDER': str(tmp_path / 'archive'),
+        'BACKUP_FOLDER': str(tmp_path / 'backups'),
+        'SHARD_FOLDER': str(tmp_path / 'shards'),
+        'SHARD_COUNT': 0,
+    }
+
+
+@pytest.fixture
+def app_module(app_config):
+    """The app module, configured against a throwaway database."""
+    coupons_app.create_app(app_config)
+    yield coupons_app
+    coupons_app._qr_cleanup_queue.join()
+    coupons_app.close_db()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def make_coupons(app_module):
+    """Inserts coupons with the given codes (and optional fields) through the store."""
+    def make(*codes, client='', created_at=None, expires_in=24 * 3600):
+        now = app_module.now_epoch() if created_at is None else created_at
+        app_module.store.insert_bulk([
+            {'email': None, 'code': code, 'client': client, 'domain': app_module.DEFAULT_DOMAIN,
+             'created_at': now, 'expires_at': now + expires_in}
+            for code in codes
+        ])
+        app_module.mark_codes_created(list(codes))
+        return list(codes)
+    return make
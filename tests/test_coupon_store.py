@@ -0,0 +1,155 @@
+"""
+The same cases run on MemoryCouponStore and SQLiteCouponStore, which must
+give the same answers (see CouponStore).
+"""
+import pytest
+
+BACKENDS = ['memory', 'sqlite']
+DAY = 24 * 3600
+
+
+@pytest.fixture(params=BACKENDS)
+def store(request, app_module):
+    if request.param == 'memory':
+        return app_module.MemoryCouponStore()
+    return app_module.SQLiteCouponStore()
+
+
+def coupon(app_module, code, client='', created_at=None, expires_in=DAY, email=None):
+    created_at = app_module.now_epoch() if created_at is None else created_at
+    return {
+        'email': email, 'code': code, 'client': client, 'domain': app_module.DEFAULT_DOMAIN,
+        'created_at': created_at, 'expires_at': created_at + expires_in,
+    }
+
+
+def seed(app_module, store):
+    """Ten coupons over two clients (and none), with distinct created_at values."""
+    now = app_module.now_epoch()
+    codes = ['VIPB000', 'VIPA001', 'VIPZ002', 'VIP9003', 'VIPC004', 'VIPA005', 'VIPQ006', 'VIP0007', 'VIPM008', 'VIPK009']
+    clients = ['acme', 'ACME', 'bravo', '', 'bravo', 'acme', '', 'Bravo', 'acme', 'acme']
+    store.insert_bulk([
+        coupon(app_module, code, client, created_at=now - 100 + (7 * i) % 10)
+        for i, (code, client) in enumerate(zip(codes, clients))
+    ])
+    return codes
+
+
+def walk(app_module, store, sort, descending, limit=3, **filters):
+    """Every listed code, following the keyset cursor a page at a time."""
+    filters = dict(app_module.history_filters({})[0], **filters)
+    codes = []
+    cursor = None
+    while True:
+        rows = list(store.list(filters, sort, descending, cursor, limit))
+        codes.extend(row['code'] for row in rows)
+        if len(rows) < limit:
+            return codes
+        last = rows[-1]
+        cursor = [last['code_num'] if sort == 'code' else last[sort], last['id']]
+
+
+def test_abstract_hooks_must_be_implemented(app_module):
+    with pytest.raises(TypeError):
+        app_module.CouponStore()
+
+
+def test_redeem_states(app_module, store):
+    now = app_module.now_epoch()
+    store.insert_bulk([
+        coupon(app_module, 'VIPAAAA'),
+        coupon(app_module, 'VIPAAAB', created_at=now - 2 * DAY, expires_in=DAY),
+    ])
+    assert store.redeem('VIPAAAA') == 'valid'
+    assert store.redeem('VIPAAAA') == 'redeemed'
+    assert store.redeem('VIPAAAB') == 'expired'
+    assert store.redeem('VIPAAAC') == 'not_found'
+    assert store.redeem('NOTACODE') == 'not_found'
+
+
+@pytest.mark.parametrize('sort', ['id', 'created_at', 'code'])
+@pytest.mark.parametrize('descending', [True, False])
+def test_keyset_list_order(app_module, store, sort, descending):
+    codes = seed(app_module, store)
+    rows = list(store.list(app_module.history_filters({})[0], sort, descending, None, 100))
+    key = {
+        'id': lambda row: row['id'],
+        'created_at': lambda row: (row['created_at'], row['id']),
+        'code': lambda row: (app_module.code_index(row['code']), row['id']),
+    }[sort]
+    expected = [row['code'] for row in sorted(rows, key=key, reverse=descending)]
+    assert sorted(expected) == sorted(codes)
+    assert walk(app_module, store, sort, descending) == expected
+
+
+def test_list_filters_by_client_and_status(app_module, store):
+    seed(app_module, store)
+    store.redeem('VIPA001')
+    app_module.sweep_expired()
+    assert walk(app_module, store, 'id', False, client='Acme') == ['VIPB000', 'VIPA001', 'VIPA005', 'VIPM008', 'VIPK009']
+    assert walk(app_module, store, 'id', False, status='redeemed') == ['VIPA001']
+
+
+def test_counts_and_clients(app_module, store):
+    seed(app_module, store)
+    assert store.count() == 10
+    assert store.count('acme') == 5
+    assert store.count('BRAVO') == 3
+    # The first spelling of a name is the one kept
+    assert [client['name'] for client in store.clients()] == ['acme', 'bravo']
+    assert store.client('Acme')['name'] == 'acme'
+    assert store.client('nobody') is None
+
+
+def test_stats(app_module, store):
+    seed(app_module, store)
+    store.redeem('VIPA001')
+    store.redeem('VIPZ002')
+    stats = {row['client']: row for row in store.stats()}
+    assert sorted(stats) == ['', 'acme', 'bravo']
+    assert (stats['acme']['issued'], stats['acme']['redeemed'], stats['acme']['active']) == (5, 1, 4)
+    assert (stats['bravo']['issued'], stats['bravo']['redeemed'], stats['bravo']['active']) == (3, 1, 2)
+    assert stats['']['issued'] == 2
+
+
+def test_delete(app_module, store):
+    codes = seed(app_module, store)
+    store.redeem(codes[0])
+    assert store.delete([codes[0], codes[1], 'VIPZZZZ']) == 2
+    assert store.delete([codes[0]]) == 0
+    assert store.redeem(codes[0]) == 'not_found'
+    assert store.redeem(codes[1]) == 'not_found'
+    assert store.count() == 8
+    assert store.count('acme') == 3
+    assert codes[0] not in walk(app_module, store, 'id', True)
+
+
+def test_allocate_skips_existing_codes(app_module, store):
+    seed(app_module, store)
+    codes = store.allocate('acme', 50)
+    assert len(set(codes)) == 50
+    store.insert_bulk([coupon(app_module, code, 'acme') for code in codes])
+    assert store.count('acme') == 55
+
+
+def test_backends_agree(app_module):
+    """Same operations on both backends, same listings and stats."""
+    results = []
+    for backend in (app_module.MemoryCouponStore(), app_module.SQLiteCouponStore()):
+        seed(app_module, backend)
+        redeemed = [backend.redeem(code) for code in ('VIPA001', 'VIPA001', 'VIPQ006', 'VIPZZZZ')]
+        backend.delete(['VIPC004'])
+        listing = [
+            {field: row[field] for field in ('id', 'code', 'redeemed', 'client', 'created_at', 'code_num')}
+            for row in backend.list(app_module.history_filters({})[0], 'created_at', True, None, 100)
+        ]
+        stats = [{key: row[key] for key in ('client', 'issued', 'redeemed', 'active')} for row in backend.stats()]
+        results.append((redeemed, listing, stats, backend.count(), backend.count('acme')))
+    assert results[0] == results[1]
+
+
+def test_generated_codes_fit_the_code_space(app_module):
+    for _ in range(200):
+        code = app_module.generate_coupon_code('AB')
+        assert code.startswith((app_module.CODE_PREFIX + 'A', app_module.CODE_PREFIX + 'B'))
+        assert app_module.code_index(code) is not None
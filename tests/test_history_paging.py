@@ -0,0 +1,79 @@
+"""Keyset paging through /history (?after= / ?before= cursors)."""
+import html
+import json
+import re
+
+import pytest
+
+CODES = ['VIPK%03d' % n for n in range(23)]
+
+
+def page(client, url):
+    """The codes listed on a page, and its Previous / Next links."""
+    body = client.get(url).get_data(as_text=True)
+    links = {
+        label: html.unescape(href)
+        for href, label in re.findall(r'<a href="([^"]*)">(?:&laquo; )?(Previous|Next)', body)
+    }
+    # Each code shows up more than once in its row (text, checkbox, forms)
+    return list(dict.fromkeys(re.findall(r'VIP[A-Z0-9]{4}', body))), links
+
+
+@pytest.fixture
+def seeded(app_module, make_coupons):
+    # Two batches with the same created_at, so ties are broken by id
+    make_coupons(*CODES[:12], client='acme', created_at=1760000000)
+    make_coupons(*CODES[12:], client='bravo', created_at=1760003600)
+    return app_module
+
+
+@pytest.mark.parametrize('sort', ['id', 'created_at', 'expires_at', 'code'])
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_next_and_previous_cover_every_coupon_once(seeded, client, sort, order):
+    url = f'/history?sort={sort}&order={order}&per_page=5'
+    pages = []
+    while url:
+        codes, links = page(client, url)
+        pages.append(codes)
+        url = links.get('Next')
+    forward = [code for codes in pages for code in codes]
+    assert sorted(forward) == sorted(CODES)
+    if sort == 'code':
+        assert forward == sorted(CODES, reverse=order == 'desc')
+
+    # And back again from the last page
+    url = links.get('Previous')
+    backward = [pages[-1]]
+    while url:
+        codes, links = page(client, url)
+        backward.insert(0, codes)
+        url = links.get('Previous')
+    assert backward == pages
+
+
+def test_filters_are_kept_across_pages(seeded, client):
+    codes, links = page(client, '/history?client=ACME&per_page=5')
+    seen = list(codes)
+    while 'Next' in links:
+        assert 'client=ACME' in links['Next']
+        codes, links = page(client, links['Next'])
+        seen.extend(codes)
+    assert sorted(seen) == CODES[:12]
+
+
+@pytest.mark.parametrize('cursor', [
+    '[1,[2]]', '[{},1]', '[1,"2"]', '[1,2.5]', '[1]', '"x"', 'null',
+])
+def test_tampered_cursors_start_from_the_first_page(seeded, client, cursor):
+    first, _ = page(client, '/history?per_page=5')
+    token = seeded.encode_cursor(json.loads(cursor))
+    for arg in ('after', 'before'):
+        response = client.get(f'/history?per_page=5&{arg}={token}')
+        assert response.status_code == 200
+        response.get_data()
+        assert page(client, f'/history?per_page=5&{arg}={token}')[0] == first
+
+
+def test_undecodable_cursor_starts_from_the_first_page(seeded, client):
+    first, _ = page(client, '/history?per_page=5')
+    assert page(client, '/history?per_page=5&after=%%%not-base64')[0] == first
@@ -0,0 +1,134 @@
+"""Migrating a database written before the first migration (user_version 0)."""
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import app as coupons_app
+
+# The coupons table as the app created it before migrations existed
+V0_SCHEMA = '''
+    CREATE TABLE coupons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT,
+        code TEXT UNIQUE,
+        created_at TIMESTAMP,
+        expires_at TIMESTAMP,
+        redeemed INTEGER DEFAULT 0,
+        domain TEXT,
+        client TEXT,
+        redeemed_at TIMESTAMP
+    )
+'''
+V0_ROWS = [
+    # id, email, code, created_at, expires_at, redeemed, domain, client, redeemed_at
+    (1, 'a@example.com', 'VIPAB12', '2025-03-12 03:09:24.972414', '2025-04-11 03:09:24.972414', 1,
+     'example.com', 'Acme', '2025-03-13 10:00:00'),
+    (2, None, 'VIPCD34', '2025-03-12 03:09:24', '2099-01-01 00:00:00', 0, 'example.com', 'ACME', None),
+    (3, 'b@example.com', 'LEGACY-1', '2025-03-14 12:00:00', '2099-01-01 00:00:00', 0, 'example.com', 'bravo', None),
+    (5, None, 'VIPZZ99', '2025-03-15 08:30:00.5', 'not a date', 0, 'example.com', '', None),
+]
+
+
+def local_epoch(text):
+    return int(datetime.fromisoformat(text).timestamp())
+
+
+@pytest.fixture
+def migrated(app_config):
+    """A v0 database with a deleted row (id 4, sequence at 6), migrated by create_app."""
+    conn = sqlite3.connect(app_config['DATABASE'])
+    conn.execute(V0_SCHEMA)
+    conn.executemany("INSERT INTO coupons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", V0_ROWS)
+    conn.execute("UPDATE sqlite_sequence SET seq = 6 WHERE name = 'coupons'")
+    conn.commit()
+    conn.close()
+    coupons_app.create_app(app_config)
+    yield coupons_app.get_db()
+    coupons_app.close_db()
+
+
+def test_schema_is_current(migrated):
+    assert migrated.execute("PRAGMA user_version").fetchone()[0] == len(coupons_app.MIGRATIONS)
+    assert migrated.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+
+
+def test_rows_survive(migrated):
+    rows = migrated.execute(
+        "SELECT id, code, code_num, code_text, created_at, expires_at, redeemed_at, status FROM coupons ORDER BY id"
+    ).fetchall()
+    assert rows == [
+        (1, 'VIPAB12', coupons_app.code_index('VIPAB12'), None, local_epoch('2025-03-12 03:09:24'),
+         local_epoch('2025-04-11 03:09:24'), local_epoch('2025-03-13 10:00:00'), 'redeemed'),
+        (2, 'VIPCD34', coupons_app.code_index('VIPCD34'), None, local_epoch('2025-03-12 03:09:24'),
+         local_epoch('2099-01-01 00:00:00'), None, 'active'),
+        (3, 'LEGACY-1', None, 'LEGACY-1', local_epoch('2025-03-14 12:00:00'),
+         local_epoch('2099-01-01 00:00:00'), None, 'active'),
+        # Unparseable text is left for to_epoch / EXPIRES_AT_EPOCH_SQL
+        (5, 'VIPZZ99', coupons_app.code_index('VIPZZ99'), None, local_epoch('2025-03-15 08:30:00'),
+         'not a date', None, 'active'),
+    ]
+
+
+def test_sequence_continues_after_deleted_rows(migrated):
+    assert migrated.execute("SELECT seq FROM sqlite_sequence WHERE name = 'coupons'").fetchone()[0] == 6
+    coupons_app.store.insert_bulk([{
+        'email': None, 'code': 'VIPNEW1', 'client': 'acme', 'domain': 'example.com',
+        'created_at': coupons_app.now_epoch(), 'expires_at': coupons_app.now_epoch() + 3600,
+    }])
+    assert migrated.execute("SELECT id, client FROM coupons WHERE code_num = ?",
+                            (coupons_app.code_index('VIPNEW1'),)).fetchone() == (7, 'Acme')
+
+
+def test_client_names_are_interned(migrated):
+    clients = migrated.execute("SELECT id, name FROM clients ORDER BY id").fetchall()
+    assert [name for _, name in clients] == ['Acme', 'bravo']
+    ids = dict((name, id_) for id_, name in clients)
+    assert migrated.execute("SELECT id, client, client_id FROM coupons ORDER BY id").fetchall() == [
+        (1, 'Acme', ids['Acme']), (2, 'Acme', ids['Acme']), (3, 'bravo', ids['bravo']), (5, '', None),
+    ]
+
+
+def test_counters_and_rollups(migrated):
+    assert migrated.execute("SELECT value FROM counters WHERE name = 'coupons'").fetchone()[0] == 4
+    assert migrated.execute("SELECT client, issued, redeemed FROM client_stats ORDER BY client").fetchall() == [
+        ('', 1, 0), ('Acme', 2, 1), ('bravo', 1, 0),
+    ]
+    assert migrated.execute("SELECT SUM(issued), SUM(redeemed) FROM batch_stats").fetchone() == (4, 1)
+    assert migrated.execute("SELECT SUM(count) FROM redeem_latency").fetchone()[0] == 1
+
+
+def test_search_index_follows_the_rebuilt_table(migrated):
+    if not migrated.execute("SELECT 1 FROM sqlite_master WHERE name = 'coupons_fts'").fetchone():
+        pytest.skip("SQLite build without FTS5 trigram")
+
+    def search(term):
+        return sorted(rowid for (rowid,) in migrated.execute(
+            "SELECT rowid FROM coupons_fts WHERE coupons_fts MATCH ?", (f'"{term}"',)
+        ))
+    assert search('acme') == [1, 2]
+    assert search('LEGACY') == [3]
+    assert search('VIPCD') == [2]
+    with migrated:
+        migrated.execute("DELETE FROM coupons WHERE id = 3")
+    assert search('LEGACY') == []
+
+
+def test_triggers_survive(migrated):
+    with migrated:
+        migrated.execute("INSERT INTO archived_codes (code, status, archived_at, partition) VALUES ('VIPQQQQ', 2, 0, 'x')")
+    with pytest.raises(sqlite3.IntegrityError):
+        with migrated:
+            migrated.execute("INSERT INTO coupons (code_num, created_at) VALUES (?, 0)",
+                             (coupons_app.code_index('VIPQQQQ'),))
+    with migrated:
+        migrated.execute("UPDATE coupons SET redeemed = 1 WHERE id = 2")
+    assert migrated.execute("SELECT status FROM coupons WHERE id = 2").fetchone()[0] == 'redeemed'
+    assert migrated.execute("SELECT issued, redeemed FROM client_stats WHERE client = 'Acme'").fetchone() == (2, 2)
+
+
+def test_status_map_is_rebuilt(migrated):
+    assert coupons_app.store.redeem('VIPAB12') == 'redeemed'
+    assert coupons_app.store.redeem('VIPCD34') == 'valid'
+    assert coupons_app.store.redeem('LEGACY-1') == 'valid'
+    assert coupons_app.store.redeem('VIPZZ99') == 'valid'
@@ -0,0 +1,68 @@
+"""Conflict rules of /sync_redemptions (offline scanner batches)."""
+import time
+
+
+def sync(client, *scans):
+    response = client.post('/sync_redemptions', json={'scans': [
+        {'code': code, 'scanned_at': scanned_at, 'device_id': 'till-1'} for code, scanned_at in scans
+    ]})
+    assert response.status_code == 200
+    return [(result['status'], result['message']) for result in response.get_json()['results']]
+
+
+def test_earliest_scan_wins(client, make_coupons):
+    make_coupons('VIPAAAA')
+    now = int(time.time())
+    results = sync(client, ('VIPAAAA', now), ('VIPAAAA', now - 60))
+    assert [status for status, _ in results] == ['duplicate', 'redeemed']
+    assert results[0][1] == "An earlier scan already redeemed this coupon."
+
+
+def test_redeemed_before_sync_is_never_a_duplicate(app_module, client, make_coupons):
+    make_coupons('VIPAAAA')
+    assert app_module.store.redeem('VIPAAAA') == 'valid'
+    now = int(time.time())
+    results = sync(client, ('VIPAAAA', now - 60), ('VIPAAAA', now))
+    assert results == [('already_redeemed', app_module.STATE_MESSAGES['redeemed'])] * 2
+
+
+def test_expiry_is_checked_at_scan_time(app_module, client, make_coupons):
+    now = int(time.time())
+    make_coupons('VIPAAAA', 'VIPAAAB', created_at=now - 7200, expires_in=3600)
+    results = sync(client, ('VIPAAAA', now - 5400), ('VIPAAAB', now - 1800), ('VIPAAAB', now - 1700))
+    assert [status for status, _ in results] == ['redeemed', 'expired', 'expired']
+    assert app_module.store.redeem('VIPAAAA') == 'redeemed'
+
+
+def test_unknown_codes_and_messages(app_module, client):
+    assert sync(client, ('VIPZZZZ', int(time.time()))) == [('not_found', app_module.STATE_MESSAGES['not_found'])]
+
+
+def test_unreadable_scan_times_only_fail_their_scan(client, make_coupons):
+    make_coupons('VIPAAAA', 'VIPAAAB')
+    now = time.time()
+    results = sync(
+        client,
+        ('VIPAAAA', 1e30), ('VIPAAAA', 'yesterday'), ('VIPAAAA', None), ('VIPAAAA', True),
+        ('VIPAAAA', '9999-12-31T00:00:00'), ('VIPAAAB', now * 1000),
+    )
+    assert [status for status, _ in results] == ['invalid'] * 5 + ['redeemed']
+    response = client.post(
+        '/sync_redemptions', data='{"scans": [{"code": "VIPAAAA", "scanned_at": NaN}]}',
+        content_type='application/json'
+    )
+    assert response.get_json()['results'][0]['status'] == 'invalid'
+
+
+def test_milliseconds_are_read_as_seconds(app_module):
+    assert app_module.parse_scan_time(1760000000123) == 1760000000
+    assert app_module.parse_scan_time(1760000000) == 1760000000
+    assert app_module.parse_scan_time('2025-10-09T08:53:20+00:00') == 1760000000
+
+
+def test_unparseable_legacy_expiry_never_expires(app_module, client, make_coupons):
+    make_coupons('VIPAAAA', 'VIPAAAB')
+    with app_module.get_db() as conn:
+        conn.execute("UPDATE coupons SET expires_at = 'not a date' WHERE code = 'VIPAAAA'")
+    results = sync(client, ('VIPAAAA', int(time.time())), ('VIPAAAB', int(time.time())))
+    assert [status for status, _ in results] == ['redeemed', 'redeemed']